@@ -1,7 +1,22 @@
+import contextlib
 import os
 import unittest
 from __main__ import vtk, qt, ctk, slicer
 import numpy as np
+from ColonicAnalysisLib.Bootstrap import bootstrapStatistics
+from ColonicAnalysisLib.Dicom import DicomHeaderCache, loadDicomStudy
+from ColonicAnalysisLib.LabelStatistics import (COLON_REGIONS, STATS_KEYS, LabelStatsTracker, labelStatistics,
+                                                stackStatistics, statsRecords, statsTable, sweepThresholds,
+                                                thresholdSweep)
+from ColonicAnalysisLib.Memory import LABEL_DTYPE, VTK_SCALAR_TYPES, compactDtype, formatMemoryReport
+from ColonicAnalysisLib.Naming import ROLES, TIMEPOINTS, classifyVolumeName, volumeRoles
+from ColonicAnalysisLib.Parallel import runParallel
+from ColonicAnalysisLib.Profiling import Profiler, profileMethods, unprofileMethods
+from ColonicAnalysisLib.StatsCache import StatsCache, statsKey
+from ColonicAnalysisLib.StatsIO import (intervalsAsCSV, saveStatsFile, statsAsCSV, sweepAsCSV, transitRecords,
+                                        transitTableAsCSV)
+from ColonicAnalysisLib.Threshold import VolumeHistogram, backgroundThreshold, buildThresholdIndex, thresholdVoxels
+from ColonicAnalysisLib.Workspace import readSnapshot, writeSnapshot
 
 
 #
@@ -54,12 +69,21 @@ class ColonicAnalysis:
 
 
 class ColonicAnalysisWidget:
+  # header, profiler record key and format of the profiling table columns
+  profilingColumns = (("Step", None, "%s"), ("Calls", 'calls', "%d"), ("Seconds", 'seconds', "%.3f"),
+                      ("Peak MB", 'peakBytes', "%.1f"), ("Volumes Added", 'volumesAdded', "%d"))
+
   def __init__(self, parent = None):
     self.fileName = None
     self.fileDialog = None
     self.renderType = ('TH', 'threshold')
     self.parameterNode = None
+    # cached result of _findParameterNodeInScene, dropped when nodes are added or removed
+    self.cachedParameterNode = None
     self.observerTags = []
+    # scene ModifiedEvents are handled at most once per event loop turn
+    self.sceneUpdatePending = False
+    self.sceneEventsAbsorbed = 0
     if not parent:
       self.parent = slicer.qMRMLWidget()
       self.parent.setLayout(qt.QVBoxLayout())
@@ -71,8 +95,11 @@ class ColonicAnalysisWidget:
       self.setup()
       self.parent.show()
     self.updateParameterNode(self.parameterNode, vtk.vtkCommand.ModifiedEvent)
-    tag = slicer.mrmlScene.AddObserver(vtk.vtkCommand.ModifiedEvent, self.updateParameterNode)
+    tag = slicer.mrmlScene.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onSceneModified)
     self.observerTags.append( (slicer.mrmlScene, tag) )
+    for event in (slicer.mrmlScene.NodeAddedEvent, slicer.mrmlScene.NodeRemovedEvent):
+      tag = slicer.mrmlScene.AddObserver(event, self.onSceneNodesChanged)
+      self.observerTags.append( (slicer.mrmlScene, tag) )
     self.setMRMLDefaults()
 
   def setup(self):
@@ -104,6 +131,50 @@ class ColonicAnalysisWidget:
     reloadFormLayout.addWidget(self.reloadAndTestButton)
     self.reloadAndTestButton.connect('clicked()', self.onReloadAndTest)
 
+    self.sceneEventsLabel = qt.QLabel()
+    self.sceneEventsLabel.toolTip = "Scene modified events merged into an earlier GUI update."
+    reloadFormLayout.addRow("Scene events absorbed:", self.sceneEventsLabel)
+    self.updateSceneEventsLabel()
+
+    #
+    # Profiling area
+    #
+    profilingCollapsibleButton = ctk.ctkCollapsibleButton()
+    profilingCollapsibleButton.text = "Profiling"
+    self.layout.addWidget(profilingCollapsibleButton)
+    profilingFormLayout = qt.QFormLayout(profilingCollapsibleButton)
+    profilingCollapsibleButton.setChecked(False)
+    self.profilingCheckBox = qt.QCheckBox("Profile logic steps")
+    self.profilingCheckBox.toolTip = "Record calls, time, memory and cloned volumes of every logic step."
+    profilingFormLayout.addRow(self.profilingCheckBox)
+    self.profilingTable = qt.QTableWidget(0, len(self.profilingColumns))
+    self.profilingTable.setHorizontalHeaderLabels([header for header, key, fmt in self.profilingColumns])
+    self.profilingTable.verticalHeader().visible = False
+    profilingFormLayout.addRow(self.profilingTable)
+    profilingButtonsFrame = qt.QFrame()
+    profilingButtonsFrame.setLayout(qt.QHBoxLayout())
+    self.profilingRefreshButton = qt.QPushButton("Refresh")
+    self.profilingResetButton = qt.QPushButton("Reset")
+    self.profilingExportButton = qt.QPushButton("Export JSON")
+    self.memoryReportButton = qt.QPushButton("Memory")
+    self.memoryReportButton.toolTip = "Show the memory held by the volumes of each timepoint."
+    for button in (self.profilingRefreshButton, self.profilingResetButton, self.profilingExportButton,
+                   self.memoryReportButton):
+      profilingButtonsFrame.layout().addWidget(button)
+    profilingFormLayout.addRow(profilingButtonsFrame)
+    self.statsMemorySpinBox = qt.QSpinBox()
+    self.statsMemorySpinBox.maximum = 65536
+    self.statsMemorySpinBox.suffix = " MB"
+    self.statsMemorySpinBox.specialValueText = "Unlimited"
+    self.statsMemorySpinBox.toolTip = "Compute the statistics in slabs using at most this much working memory."
+    profilingFormLayout.addRow("Statistics memory:", self.statsMemorySpinBox)
+    self.statsMemorySpinBox.connect('valueChanged(int)', self.onStatsMemoryChanged)
+    self.profilingCheckBox.connect('toggled(bool)', self.onProfilingToggled)
+    self.profilingRefreshButton.connect('clicked()', self.updateProfilingTable)
+    self.profilingResetButton.connect('clicked()', self.onProfilingReset)
+    self.profilingExportButton.connect('clicked()', self.onProfilingExport)
+    self.memoryReportButton.connect('clicked()', self.onMemoryReport)
+
     #
     # preprocess area
     #
@@ -111,6 +182,11 @@ class ColonicAnalysisWidget:
     preprocessCollapsibleButton.text = "Preprocess"
     self.layout.addWidget(preprocessCollapsibleButton)
     preprocessFormLayout = qt.QFormLayout(preprocessCollapsibleButton)
+    # load DICOM study button
+    self.loadDicomButton = qt.QPushButton("Load DICOM Study")
+    self.loadDicomButton.toolTip = "Load the SPECT and CTAC series of all timepoints in a directory."
+    preprocessFormLayout.addRow(self.loadDicomButton)
+    self.loadDicomButton.connect('clicked()', self.onLoadDicom)
     # fix volumes button
     self.fixvolumesButton = qt.QPushButton("Fix Volumes")
     preprocessFormLayout.addRow(self.fixvolumesButton)
@@ -121,6 +197,10 @@ class ColonicAnalysisWidget:
     self.slider.decimals = 0
     self.slider.enabled = False
     preprocessFormLayout.addRow("Threshold", self.slider)
+    self.thresholdPreviewCheckBox = qt.QCheckBox("Preview threshold")
+    self.thresholdPreviewCheckBox.toolTip = "Threshold the SPECT display only. The threshold volumes are made when the labels are created."
+    preprocessFormLayout.addRow(self.thresholdPreviewCheckBox)
+    self.thresholdPreviewCheckBox.connect('toggled(bool)', self.onThresholdPreviewToggled)
     self.fixvolumesButton.connect('clicked()', self.onFixvolumes)
     self.thresholdButton.connect('clicked()', self.onCalcThresholds)
     preprocessCollapsibleButton.setChecked(False)
@@ -131,6 +211,18 @@ class ColonicAnalysisWidget:
     self.editorButton = qt.QPushButton("Create Labels")
     preprocessFormLayout.addRow(self.editorButton)
     self.editorButton.connect('clicked()', self.onCreateLabels)
+    # workspace snapshot buttons
+    snapshotButtonsFrame = qt.QFrame(self.parent)
+    snapshotButtonsFrame.setLayout(qt.QHBoxLayout())
+    self.saveSnapshotButton = qt.QPushButton("Save Snapshot")
+    self.saveSnapshotButton.toolTip = "Save the thresholds and labels of the study, without the volumes."
+    self.restoreSnapshotButton = qt.QPushButton("Restore Snapshot")
+    self.restoreSnapshotButton.toolTip = "Restore a study saved with Save Snapshot."
+    for button in (self.saveSnapshotButton, self.restoreSnapshotButton):
+      snapshotButtonsFrame.layout().addWidget(button)
+    preprocessFormLayout.addRow(snapshotButtonsFrame)
+    self.saveSnapshotButton.connect('clicked()', self.onSaveSnapshot)
+    self.restoreSnapshotButton.connect('clicked()', self.onRestoreSnapshot)
 
 
     #
@@ -211,9 +303,22 @@ class ColonicAnalysisWidget:
     #self.statsButton.name = "6HR"
     self.parent.layout().addWidget(self.statsButton)
 
+    # live statistics while painting labels
+    self.liveStatsCheckBox = qt.QCheckBox("Live statistics")
+    self.liveStatsCheckBox.toolTip = "Update the statistics table as the label volume is painted."
+    self.parent.layout().addWidget(self.liveStatsCheckBox)
+
+    # bootstrap confidence intervals of the statistics
+    self.intervalsCheckBox = qt.QCheckBox("Confidence intervals")
+    self.intervalsCheckBox.toolTip = "Show Poisson bootstrap intervals of the region fractions and geometric centre."
+    self.parent.layout().addWidget(self.intervalsCheckBox)
+
     # model and view for stats table
     self.view = qt.QTableView()
     self.view.sortingEnabled = True
+    self.model = ColonicAnalysisStatsModel(self.view)
+    self.view.setModel(self.model)
+    self.view.verticalHeader().visible = False
     self.parent.layout().addWidget(self.view)
 
 
@@ -223,12 +328,34 @@ class ColonicAnalysisWidget:
     self.saveButton.enabled = False
     self.parent.layout().addWidget(self.saveButton)
 
+    # Threshold sweep button
+    self.sweepButton = qt.QPushButton("Threshold Sweep")
+    self.sweepButton.toolTip = "Save the geometric centre of every timepoint over a range of thresholds."
+    self.sweepButton.enabled = False
+    self.parent.layout().addWidget(self.sweepButton)
+
+    # Confidence intervals button
+    self.intervalsButton = qt.QPushButton("Save Confidence Intervals")
+    self.intervalsButton.toolTip = "Save the bootstrap intervals of every timepoint."
+    self.intervalsButton.enabled = False
+    self.parent.layout().addWidget(self.intervalsButton)
+
     # make connections
     self.statsButton.connect('clicked()', self.onStats)
+    self.liveStatsCheckBox.connect('toggled(bool)', self.onLiveStatsToggled)
     self.saveButton.connect('clicked()', self.onSave)
+    self.sweepButton.connect('clicked()', self.onThresholdSweep)
+    self.intervalsCheckBox.connect('toggled(bool)', self.onIntervalsToggled)
+    self.intervalsButton.connect('clicked()', self.onSaveIntervals)
     self.refreshButton.connect('clicked()', self.onRefresh)
     self.slider.connect('valueChanged(double)', self.onSliderValueChanged)
 
+    # apply the threshold while the slider is dragged, at most once per frame
+    self.thresholdTimer = qt.QTimer()
+    self.thresholdTimer.setSingleShot(True)
+    self.thresholdTimer.setInterval(33)
+    self.thresholdTimer.connect('timeout()', self.onThresholdTimeout)
+
 
     # call refresh the slider to set it's initial state
     self.onRefresh()
@@ -238,10 +365,65 @@ class ColonicAnalysisWidget:
 
   def getParameterNode(self):
     """Get the ColonicAnalysis parameter node - a singleton in the scene"""
-    node = self._findParameterNodeInScene()
-    if not node:
-      node = self._createParameterNode()
-    return node
+    if not self.cachedParameterNode:
+      node = self._findParameterNodeInScene()
+      if not node:
+        node = self._createParameterNode()
+      self.cachedParameterNode = node
+    return self.cachedParameterNode
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onSceneNodesChanged(self, caller, event, node):
+    if node and node.IsA("vtkMRMLScriptedModuleNode"):
+      self.cachedParameterNode = None
+
+  def onSceneModified(self, caller, event):
+    """Coalesce scene modified events into one update per event loop turn"""
+    if self.sceneUpdatePending:
+      self.sceneEventsAbsorbed += 1
+      return
+    self.sceneUpdatePending = True
+    qt.QTimer.singleShot(0, self.onSceneModifiedTimeout)
+
+  def onSceneModifiedTimeout(self):
+    self.sceneUpdatePending = False
+    self.updateParameterNode(slicer.mrmlScene, vtk.vtkCommand.ModifiedEvent)
+    self.updateSceneEventsLabel()
+
+  def onProfilingToggled(self, checked):
+    self.logic.setProfiling(checked)
+    self.updateProfilingTable()
+
+  def onProfilingReset(self):
+    self.logic.profiler.reset()
+    self.updateProfilingTable()
+
+  def onProfilingExport(self):
+    fileName = qt.QFileDialog.getSaveFileName(self.parent, "Export Profile", "", "JSON (*.json)")
+    if fileName:
+      self.logic.profiler.saveJSON(fileName)
+
+  def onStatsMemoryChanged(self, value):
+    self.logic.statsMemoryBudget = value * 1048576 if value else None
+
+  def onMemoryReport(self):
+    self.logic.updateActiveVolumes()
+    qt.QMessageBox.information(slicer.util.mainWindow(), "Memory", self.logic.memoryReport())
+
+  def updateProfilingTable(self):
+    report = self.logic.profiler.report()
+    self.profilingTable.setRowCount(len(report))
+    for row, (name, record) in enumerate(report):
+      for column, (header, key, fmt) in enumerate(self.profilingColumns):
+        value = name if key is None else record[key]
+        if key == 'peakBytes':
+          value /= 1048576.0
+        self.profilingTable.setItem(row, column, qt.QTableWidgetItem(fmt % value))
+    self.profilingTable.resizeColumnsToContents()
+
+  def updateSceneEventsLabel(self):
+    if hasattr(self, 'sceneEventsLabel'):
+      self.sceneEventsLabel.text = str(self.sceneEventsAbsorbed)
 
   def _findParameterNodeInScene(self):
     node = None
@@ -276,7 +458,7 @@ class ColonicAnalysisWidget:
     node = self.getParameterNode()
     if node != self.parameterNode:
       if self.parameterNode:
-        node.RemoveObserver(self.parameterNodeTag)
+        self.parameterNode.RemoveObserver(self.parameterNodeTag)
       self.parameterNode = node
       self.parameterNodeTag = node.AddObserver(vtk.vtkCommand.ModifiedEvent, self.updateGUIFromMRML)
 
@@ -304,7 +486,7 @@ class ColonicAnalysisWidget:
         # don't update if the parameter node has not got all values yet
         return
     thrs = self.parameterNode.GetParameter("ColonicAnalysis,thresholds")
-    print("thresholds = %s" % thrs)
+    #print("thresholds = %s" % thrs)
     #self.disconnectWidgets()
     #self.toleranceSpinBox.setValue( float(self.parameterNode.GetParameter("WandEffect,tolerance")) )
     #self.maxPixelsSpinBox.setValue( float(self.parameterNode.GetParameter("WandEffect,maxPixels")) )
@@ -326,10 +508,30 @@ class ColonicAnalysisWidget:
         self.r32HRSButton.enabled = True
       
 
+  def onLoadDicom(self):
+    directory = qt.QFileDialog.getExistingDirectory(self.parent, "DICOM Study")
+    if not directory:
+      return
+    try:
+      nodes = self.logic.loadDicomStudy(directory)
+    except ImportError as e:
+      qt.QMessageBox.critical(slicer.util.mainWindow(), "Load DICOM Study", str(e))
+      return
+    if not nodes:
+      qt.QMessageBox.warning(slicer.util.mainWindow(), "Load DICOM Study",
+          "No SPECT or CTAC series of a known timepoint found in %s" % directory)
+      return
+    self.fixvolumesButton.enabled = False
+    self.updateActiveViews()
+    active = self.logic.getActiveSpects()
+    if active:
+      self.changeView(active[0])
+
   def onFixvolumes(self):
-    self.logic.fixVolumes()
-    self.logic.setVolumeAttributes()
-    self.logic.fixSpectLevel()
+    with self.logic.sceneBatch():
+      self.logic.fixVolumes()
+      self.logic.setVolumeAttributes()
+      self.logic.fixSpectLevel()
     self.changeView(self.logic.getCurrentView())
     self.fixvolumesButton.enabled = False
     self.updateActiveViews()
@@ -351,9 +553,11 @@ class ColonicAnalysisWidget:
     self.logic.setCurrentView(view)
     self.logic.setViews(view)
     #sThr, sMax = self.logic.getThreshold(self.logic.getCurrentView())
-    self.slider.value = self.logic.getThreshold(view)
-    self.slider.maximum = self.logic.getThresholdMax(view)
+    self.setSlider(self.logic.getThreshold(view), self.logic.getThresholdMax(view))
     self.clearStats()
+    self.logic.stopLiveStats()
+    if self.liveStatsCheckBox.checked and self.volumesAreValid(view):
+      self.logic.startLiveStats(view, self.onLiveStatsUpdated)
     #if not self.logic.renderView('LA', 'label'):
     self.logic.renderView(self.logic.getCurrentView(), self.renderType[0], self.renderType[1])
     
@@ -367,24 +571,39 @@ class ColonicAnalysisWidget:
     
   def onCalcThresholds(self):
     active = self.logic.getActiveSpects()
-    for tp in active:
-      sThr = self.logic.calculateThreshold(tp)
-      self.logic.applyThreshold(tp, int(sThr))
+    with self.logic.sceneBatch():
+      thresholds = self.logic.calculateThresholds(active)
+      self.logic.applyThresholds(dict((tp, int(sThr)) for tp, sThr in zip(active, thresholds)))
     #sThr, sMax = self.logic.getThreshold(active[0])
-    self.slider.maximum = self.logic.getThresholdMax(active[0])
-    self.slider.value = self.logic.getThreshold(active[0])
+    self.setSlider(self.logic.getThreshold(active[0]), self.logic.getThresholdMax(active[0]))
     self.slider.enabled = True
     self.logic.setCurrentView(active[0])
     self.changeView(active[0])
     self.logic.updateActiveVolumes()
     self.thresholdButton.enabled = False
      
+  def setSlider(self, value, maximum):
+    """Show the threshold of a view. The maximum is set first so the value
+    is not clamped to that of the previous view, and the signals are blocked
+    so only the user moving the slider applies a threshold."""
+    wasBlocked = self.slider.blockSignals(True)
+    self.slider.maximum = maximum
+    self.slider.value = value
+    self.slider.blockSignals(wasBlocked)
+
   def onSliderValueChanged(self,value):
+    if not self.thresholdTimer.isActive():
+      self.thresholdTimer.start()
+
+  def onThresholdTimeout(self):
     current = self.logic.getCurrentView()
-    if self.logic.getThreshold(current) == 0 and value > 0:
-      self.logic.applyThreshold(current, int(value))
-      self.logic.updateActiveVolumes()
-      self.changeView(current)
+    value = int(self.slider.value)
+    if value != self.logic.getThreshold(current):
+      self.logic.applyThreshold(current, value)
+
+  def onThresholdPreviewToggled(self, checked):
+    self.logic.setThresholdPreview(checked)
+    self.changeView(self.logic.getCurrentView())
 
   def onTresholdRefresh(self):
       self.logic.applyThreshold(self.logic.getCurrentView(), self.slider.value)
@@ -392,11 +611,32 @@ class ColonicAnalysisWidget:
       
       
   def onCreateLabels(self):
-    active = self.logic.getActiveSpects()
-    for tp in active:
-      self.logic.setupPaint(tp)
+    self.logic.createLabels(self.logic.getActiveSpects())
     self.editorButton.enabled = False
      
+  def onSaveSnapshot(self):
+    fileName = qt.QFileDialog.getSaveFileName(self.parent, "Save Snapshot", "", "Workspace snapshot (*.npz)")
+    if fileName:
+      self.logic.saveSnapshot(fileName)
+
+  def onRestoreSnapshot(self):
+    fileName = qt.QFileDialog.getOpenFileName(self.parent, "Restore Snapshot", "", "Workspace snapshot (*.npz)")
+    if not fileName:
+      return
+    missing = self.logic.restoreSnapshot(fileName)
+    if missing:
+      qt.QMessageBox.warning(slicer.util.mainWindow(), "Restore Snapshot",
+          "These volumes could not be found or loaded:\n%s" % "\n".join(missing))
+    active = self.logic.getActiveSpects()
+    if not active:
+      return
+    self.fixvolumesButton.enabled = False
+    self.thresholdButton.enabled = False
+    self.slider.enabled = True
+    self.updateActiveViews()
+    current = self.logic.getCurrentView()
+    self.changeView(current if current in active else active[0])
+
   def onRefresh(self):
     volumeCount = self.logic.volumeCount()
 
@@ -421,8 +661,26 @@ class ColonicAnalysisWidget:
     self.populateStats()
     #self.chartFrame.enabled = True
     self.saveButton.enabled = True
+    self.sweepButton.enabled = True
+    self.intervalsButton.enabled = True
     self.statsButton.text = "Stats"
 
+  def onLiveStatsToggled(self, checked):
+    self.logic.stopLiveStats()
+    if not checked:
+      return
+    if not self.volumesAreValid(self.logic.getCurrentView()):
+      qt.QMessageBox.warning(slicer.util.mainWindow(),
+          "Label Statistics", "Either the SPECT or Label volume does not exist.")
+      self.liveStatsCheckBox.checked = False
+      return
+    self.logic.startLiveStats(self.logic.getCurrentView(), self.onLiveStatsUpdated)
+
+  def onLiveStatsUpdated(self, timePoint):
+    if timePoint == self.logic.getCurrentView():
+      self.populateStats(compute=False)
+      self.saveButton.enabled = True
+
   def onSave(self):
     """save the label statistics
     """
@@ -431,21 +689,40 @@ class ColonicAnalysisWidget:
       self.fileDialog.options = self.fileDialog.DontUseNativeDialog
       self.fileDialog.acceptMode = self.fileDialog.AcceptSave
       self.fileDialog.defaultSuffix = "csv"
-      self.fileDialog.setNameFilter("Comma Separated Values (*.csv)")
+      self.fileDialog.setNameFilter("Comma Separated Values (*.csv);;NumPy columnar (*.npz);;Parquet (*.parquet)")
       self.fileDialog.connect("fileSelected(QString)", self.onFileSelected)
+      self.fileDialog.connect("filterSelected(QString)", self.onSaveFilterSelected)
     self.fileDialog.show()
 
+  def onSaveFilterSelected(self, nameFilter):
+    """Give a file name typed without an extension that of the chosen format"""
+    self.fileDialog.defaultSuffix = nameFilter.split("*.")[-1].rstrip(")")
+
   def onFileSelected(self,fileName):
     self.logic.saveStats(fileName)
 
+  def onIntervalsToggled(self, checked):
+    self.logic.confidenceIntervals = checked
+    if self.model.records is not None and self.volumesAreValid(self.logic.getCurrentView()):
+      self.populateStats()
+
+  def onSaveIntervals(self):
+    fileName = qt.QFileDialog.getSaveFileName(self.parent, "Save Confidence Intervals", "", "Comma Separated Values (*.csv)")
+    if fileName:
+      with open(fileName, 'w') as fp:
+        fp.write(self.logic.intervalsAsCSV())
+
+  def onThresholdSweep(self):
+    fileName = qt.QFileDialog.getSaveFileName(self.parent, "Threshold Sweep", "", "Comma Separated Values (*.csv)")
+    if fileName:
+      with open(fileName, 'w') as fp:
+        fp.write(self.logic.thresholdSweepAsCSV())
+
   def clearStats(self):
-    self.items = []
-    self.model = qt.QStandardItemModel()
-    self.view.setModel(self.model)
-    self.view.verticalHeader().visible = False
+    self.model.setStats(None)
     
     
-  def populateStats(self):
+  def populateStats(self, compute=True):
     if not self.logic:
       return
     labelvol = slicer.util.getNode(self.logic.colonData[self.logic.getCurrentView()]['LA']['ID'])
@@ -454,53 +731,27 @@ class ColonicAnalysisWidget:
     displayNode = labelvol.GetDisplayNode()
     colorNode = displayNode.GetColorNode()
     lut = colorNode.GetLookupTable()
-    numLabels = colorNode.GetNumberOfColors()
-    self.logic.computeMean(self.logic.getCurrentView())
-    self.items = []
-    self.model = qt.QStandardItemModel()
-    self.view.setModel(self.model)
-    self.view.verticalHeader().visible = False
-    totalCounts = 0
-    row = 0
-    for i in self.logic.labelStats["Labels"]:
-      color = qt.QColor()
+    if compute:
+      self.logic.computeMean(self.logic.getCurrentView())
+    colours = {}
+    for i in self.logic.labelRecords['label']:
       rgb = lut.GetTableValue(i)
-      color.setRgb(rgb[0]*255,rgb[1]*255,rgb[2]*255)
-      item = qt.QStandardItem()
-      item.setData(color,1)
-      item.setToolTip(colorNode.GetColorName(i))
-      self.model.setItem(row,0,item)
-      self.items.append(item)
-      col = 1
-      for k in self.logic.keys:
-        item = qt.QStandardItem()
-        item.setText(str(self.logic.labelStats[i,k]))
-        item.setToolTip(colorNode.GetColorName(i))
-        #print (colorNode.GetColorName(i))
-        self.model.setItem(row,col,item)
-        self.items.append(item)
-        col += 1
-      row += 1
-
-    item = qt.QStandardItem()
-    item.setText(str(self.logic.totalCounts))
-    self.model.setItem(row,4,item)
-    self.items.append(item)
-    item = qt.QStandardItem()
-    item.setText("%2.3f" % self.logic.computedMean)
-    self.model.setItem(row,5,item)
-    self.items.append(item)
+      colours[i] = (rgb[0]*255, rgb[1]*255, rgb[2]*255, colorNode.GetColorName(i))
+    self.model.setStats(self.logic.labelRecords, self.logic.totalCounts, self.logic.computedMean, colours,
+                        self.logic.bootstrapIntervals)
     self.view.setColumnWidth(0,30)
-    self.model.setHeaderData(0,1," ")
     col = 1
     for k in self.logic.keys:
       self.view.setColumnWidth(col,15*len(k))
-      self.model.setHeaderData(col,1,k)
       col += 1
 
 
   def cleanup(self):
-    pass
+    for observee, tag in self.observerTags:
+      observee.RemoveObserver(tag)
+    self.observerTags = []
+    if hasattr(self, 'logic'):
+      self.logic.cleanup()
 
 
   def onReload(self,moduleName="ColonicAnalysis"):
@@ -561,6 +812,219 @@ class ColonicAnalysisWidget:
           "Reload and Test", 'Exception!\n\n' + str(e) + "\n\nSee Python Console for Stack Trace")
 
 
+#
+# ColonicAnalysisStatsModel
+#
+
+class ColonicAnalysisStatsModel(qt.QAbstractTableModel):
+  """Table model over the record array of label statistics from statsRecords.
+  Cells are only formatted when the view asks for them in data(), and a
+  refresh swaps the backing array and emits a single model reset.
+  The last row holds the total counts and the geometric centre. With
+  bootstrap intervals an extra column shows the interval of the fraction
+  of the total counts of each label and of the geometric centre.
+  """
+  # column header, record field and cell format
+  columns = ((" ", None, None), ("Label", 'label', "%d"), ("Voxels", 'voxels', "%d"),
+             ("Volume cc", 'volume', "%2.3f"), ("Total Counts", 'counts', None),
+             ("SPECT Mean", 'mean', "%2.3f"))
+
+  def __init__(self, parent=None):
+    qt.QAbstractTableModel.__init__(self, parent)
+    self.records = None
+    self.totalCounts = 0
+    self.computedMean = 0.0
+    self.colours = {}
+    self.intervals = None
+
+  def setStats(self, records, totalCounts=0, computedMean=0.0, colours=None, intervals=None):
+    """Show records, colours maps each label to (r, g, b, name), intervals is
+    bootstrapStatistics output or None"""
+    self.beginResetModel()
+    self.records = records
+    self.totalCounts = totalCounts
+    self.computedMean = computedMean
+    self.intervals = intervals
+    self.colours = dict((label, (qt.QColor(r, g, b), name)) for label, (r, g, b, name) in (colours or {}).items())
+    self.endResetModel()
+
+  def rowCount(self, parent=None):
+    if self.records is None:
+      return 0
+    return len(self.records) + 1
+
+  def columnCount(self, parent=None):
+    if self.intervals:
+      return len(self.columns) + 1
+    return len(self.columns)
+
+  def data(self, index, role):
+    if self.records is None or not index.isValid():
+      return None
+    row, col = index.row(), index.column()
+    if row == len(self.records):
+      if role != qt.Qt.DisplayRole:
+        return None
+      if col == 4:
+        return str(self.totalCounts)
+      if col == 5:
+        return "%2.3f" % self.computedMean
+      if col == len(self.columns):
+        return "%2.3f - %2.3f" % tuple(self.intervals['geometricCentre'])
+      return None
+    record = self.records[row]
+    colour, name = self.colours.get(record['label'], (None, None))
+    if role == qt.Qt.ToolTipRole:
+      return name
+    if role == qt.Qt.DecorationRole and col == 0:
+      return colour
+    if role == qt.Qt.DisplayRole and col == len(self.columns):
+      return "%.4f - %.4f" % tuple(self.intervals['fraction'][record['label']])
+    if role == qt.Qt.DisplayRole and col > 0:
+      header, field, fmt = self.columns[col]
+      if fmt:
+        return fmt % record[field]
+      return str(record[field])
+    return None
+
+  def headerData(self, section, orientation, role):
+    if orientation == qt.Qt.Horizontal and role == qt.Qt.DisplayRole:
+      if section == len(self.columns):
+        return "%d%% CI" % round(100 * self.intervals['confidence'])
+      return self.columns[section][0]
+    if orientation == qt.Qt.Horizontal and role == qt.Qt.ToolTipRole and section == len(self.columns):
+      return "Bootstrap interval of the fraction of the total counts, and of the geometric centre"
+    return None
+
+  def sort(self, column, order):
+    if column >= len(self.columns):
+      return
+    field = self.columns[column][1]
+    if self.records is None or not field:
+      return
+    self.beginResetModel()
+    self.records = np.sort(self.records, order=field)
+    if order == qt.Qt.DescendingOrder:
+      self.records = self.records[::-1]
+    self.endResetModel()
+
+
+#
+# ColonicAnalysisNodeRegistry
+#
+
+# volume node attributes naming the timepoint and role of volumes the module
+# made itself, and marking volumes whose geometry needs no fixVolumes
+TIMEPOINT_ATTRIBUTE = "ColonicAnalysis.TimePoint"
+ROLE_ATTRIBUTE = "ColonicAnalysis.Role"
+# name of the volume when it was tagged: copies made outside the module
+# carry the tags too, but under another name
+TAGGED_NAME_ATTRIBUTE = "ColonicAnalysis.TaggedName"
+GEOMETRY_ATTRIBUTE = "ColonicAnalysis.GeometryFixed"
+# directory of the DICOM study a volume was loaded from, see saveSnapshot
+SOURCE_ATTRIBUTE = "ColonicAnalysis.Source"
+
+
+class ColonicAnalysisNodeRegistry:
+  """Index of the volume nodes in the scene by timepoint and role (CT/SP/TH/LA).
+  Each node is classified once when it is added, by the timepoint and role
+  attributes the DICOM loader sets, as long as the node still has the name
+  it was tagged under, or else by its name. Scene NodeAdded and
+  NodeRemoved observers plus a ModifiedEvent observer on every volume node,
+  which picks up renames and retagging, keep the index current without
+  wildcard scans.
+  """
+  def __init__(self, scene, timepoints):
+    self.scene = scene
+    self.timepoints = timepoints
+    # (timepoint, role) -> node IDs in the order they were added
+    self.entries = {}
+    # node ID -> [name, [(timepoint, role)], node, observer tag]
+    self.nodes = {}
+    # volume nodes added since the registry was created, see Profiler
+    self.volumesAdded = 0
+    # functions called with the ID of every volume node removed from the scene
+    self.removedCallbacks = []
+    self.sceneTags = [
+      scene.AddObserver(scene.NodeAddedEvent, self.onNodeAdded),
+      scene.AddObserver(scene.NodeRemovedEvent, self.onNodeRemoved)]
+    for i in xrange(scene.GetNumberOfNodesByClass("vtkMRMLVolumeNode")):
+      self.addNode(scene.GetNthNodeByClass(i, "vtkMRMLVolumeNode"))
+
+  def cleanup(self):
+    for tag in self.sceneTags:
+      self.scene.RemoveObserver(tag)
+    self.sceneTags = []
+    for nodeID in list(self.nodes.keys()):
+      self.removeNode(nodeID)
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeAdded(self, caller, event, node):
+    if node and node.IsA("vtkMRMLVolumeNode"):
+      self.volumesAdded += 1
+      self.addNode(node)
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemoved(self, caller, event, node):
+    if node and node.GetID() in self.nodes:
+      self.removeNode(node.GetID())
+      for callback in self.removedCallbacks:
+        callback(node.GetID())
+
+  def onNodeModified(self, node, event):
+    self.refresh(node)
+
+  def refresh(self, node):
+    """Index node again if its name or tags have changed"""
+    entry = self.nodes.get(node.GetID())
+    if entry and (entry[0] != node.GetName() or entry[1] != self.classify(node)):
+      self.unindex(node.GetID())
+      self.index(node)
+
+  def classify(self, node):
+    timePoint = node.GetAttribute(TIMEPOINT_ATTRIBUTE)
+    role = node.GetAttribute(ROLE_ATTRIBUTE)
+    if timePoint in self.timepoints and role in ROLES and node.GetAttribute(TAGGED_NAME_ATTRIBUTE) == node.GetName():
+      return [(timePoint, role)]
+    return classifyVolumeName(node.GetName() or '', self.timepoints)
+
+  def addNode(self, node):
+    if node.GetID() in self.nodes:
+      return
+    tag = node.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onNodeModified)
+    self.nodes[node.GetID()] = [None, [], node, tag]
+    self.index(node)
+
+  def removeNode(self, nodeID):
+    self.unindex(nodeID)
+    name, matches, node, tag = self.nodes.pop(nodeID)
+    node.RemoveObserver(tag)
+
+  def index(self, node):
+    entry = self.nodes[node.GetID()]
+    entry[0] = node.GetName() or ''
+    entry[1] = self.classify(node)
+    for key in entry[1]:
+      self.entries.setdefault(key, []).append(node.GetID())
+
+  def unindex(self, nodeID):
+    for key in self.nodes[nodeID][1]:
+      self.entries[key].remove(nodeID)
+    self.nodes[nodeID][1] = []
+
+  def lookup(self, timePoint, role):
+    """ID of the most recently added node for timePoint and role, or None"""
+    ids = self.entries.get((timePoint, role))
+    return ids[-1] if ids else None
+
+  def name(self, nodeID):
+    return self.nodes[nodeID][0]
+
+  def volumeNodes(self):
+    """(name, node) for every volume node in the scene"""
+    return [(entry[0], entry[2]) for entry in self.nodes.values()]
+
+
 #
 # ColonicAnalysisLogic
 #
@@ -573,10 +1037,20 @@ class ColonicAnalysisLogic:
     requiring an instance of the Widget
     """
     def __init__(self):
-        self.keys = ("Label", "Voxels", "Volume cc", "Total Counts", "SPECT Mean")
-        self.colonRegions = ("ascending_1", "ascending_2", "transverse_1", 
-          "transverse_2", "transverse_3", "transverse_4", "neorectum", "stool")
-        self.timepoints = ("6HRS", "24HRS", "32HRS")
+        self.keys = STATS_KEYS
+        self.colonRegions = COLON_REGIONS
+        self.timepoints = TIMEPOINTS
+        self.nodeRegistry = None
+        # nesting depth and held back nodes of sceneBatch
+        self.batchDepth = 0
+        self.batchNodes = {}
+        # label statistics tracked while painting, see startLiveStats
+        self.liveStats = None
+        # recount the painted labels at most once per frame
+        self.liveStatsTimer = qt.QTimer()
+        self.liveStatsTimer.setSingleShot(True)
+        self.liveStatsTimer.setInterval(33)
+        self.liveStatsTimer.connect('timeout()', self.updateLiveStats)
         self.colonData = {
                       '6HRS': {'Name': '6HRS', 'Colour': 'Red', 'Threshold': {'val': 0, 'max': 0},
                             'CT': {'Active': False, 'Name': None, 'ID': None},
@@ -595,11 +1069,42 @@ class ColonicAnalysisLogic:
                             'LA': {'Active': False, 'Name': None, 'ID': None}}}
         self.labelStats = {}
         self.labelStats['Labels'] = []
+        # the same statistics as a record array, see statsRecords
+        self.labelRecords = None
         self.totalCounts = 0
         self.currentView = self.timepoints[0]
         self.computedMean = 0.0
         self.volumesLogic = slicer.modules.volumes.logic()
         self.hasColourtable = False
+        # 'numpy' thresholds in-process, 'cli' runs the thresholdscalarvolume module
+        self.thresholdMode = 'numpy'
+        # threshold the SPECT display only, see setThresholdPreview
+        self.thresholdPreview = False
+        # SPECT node ID -> (image data modified time, buildThresholdIndex index)
+        self.thresholdIndex = {}
+        # SPECT node ID -> (image data modified time, VolumeHistogram)
+        self.histogramCache = {}
+        # thread pool size for the per timepoint NumPy work, see runParallel
+        self.maxWorkers = 3
+        # parsed DICOM headers kept between loads, see loadDicomStudy
+        self.dicomHeaderCache = DicomHeaderCache()
+        # working memory in bytes of one statistics pass, None for a single pass
+        # over the whole volume, see labelStatistics
+        self.statsMemoryBudget = None
+        # Poisson bootstrap of the statistics in computeMean, see bootstrapStatistics
+        self.confidenceIntervals = False
+        self.bootstrapResamples = 2000
+        self.bootstrapConfidence = 0.95
+        self.bootstrapSeed = 0
+        self.bootstrapIntervals = None
+        # label statistics by content hash, kept between sessions, see StatsCache
+        self.statsCache = StatsCache(os.path.join(slicer.app.temporaryPath, 'ColonicAnalysisStatsCache'))
+        # (SPECT ID, label ID) -> (image data modified times, statsKey), so
+        # unchanged volumes are not hashed again
+        self.statsKeys = {}
+        # per method call statistics while profiling is on, see setProfiling
+        self.profiler = Profiler({'volumesAdded': self.volumesAdded})
+        self.profiledMethods = []
         #self.modulePath = '/home/markp/Projects/slicer/ColonTools/ColonicAnalysis/'
         #self.modulePath = '/Volumes/Seagate Backup Plus Drive/Colonic/ColonTools/ColonicAnalysis/'
         modName = slicer.modules.colonicanalysis.path
@@ -607,27 +1112,56 @@ class ColonicAnalysisLogic:
         self.modulePath = modName[0:lsep]
         pass
 
+    def getNodeRegistry(self):
+      if not self.nodeRegistry:
+        self.nodeRegistry = ColonicAnalysisNodeRegistry(slicer.mrmlScene, self.timepoints)
+        self.nodeRegistry.removedCallbacks.append(self.forgetNode)
+      return self.nodeRegistry
+
+    def volumesAdded(self):
+      return self.getNodeRegistry().volumesAdded
+
+    def setProfiling(self, enabled):
+      """ Route the public logic methods through self.profiler. It records per
+          method the call count, wall time and peak memory, and the number of
+          volume nodes added to the scene by cloning, loading or creating
+          labels. Calls are timed inclusively, so calculateThreshold also
+          counts the calculateThresholds call it makes.
+      """
+      if enabled and not self.profiledMethods:
+        self.profiler.start()
+        self.profiledMethods = profileMethods(self, self.profiler,
+                                              exclude=('cleanup', 'sceneBatch', 'setProfiling', 'volumesAdded'))
+      elif not enabled and self.profiledMethods:
+        unprofileMethods(self, self.profiledMethods)
+        self.profiledMethods = []
+        self.profiler.stop()
+
+    def cleanup(self):
+      self.setProfiling(False)
+      self.stopLiveStats()
+      self.statsKeys = {}
+      if self.nodeRegistry:
+        self.nodeRegistry.cleanup()
+        self.nodeRegistry = None
+
+    def forgetNode(self, nodeID):
+      """ Drop what is kept per node ID once the node has left the scene.
+      """
+      self.histogramCache.pop(nodeID, None)
+      self.thresholdIndex.pop(nodeID, None)
+      for nodeIDs in [ids for ids in self.statsKeys if nodeID in ids]:
+        del self.statsKeys[nodeIDs]
+
     def updateActiveVolumes(self):
       #print ("updateActiveVolumes()")
+      registry = self.getNodeRegistry()
       for timePoint in self.colonData:
-        nodes = slicer.util.getNodes('*%s*' % timePoint)
-        for nodeName, nodeID in nodes.items():
-            if nodeName.find("CTAC") != -1:
-                self.colonData[timePoint]['CT']['Active'] = True
-                self.colonData[timePoint]['CT']['Name'] = nodeName
-                self.colonData[timePoint]['CT']['ID']= nodeID.GetID()
-            if nodeName.endswith("Transaxials"):
-                self.colonData[timePoint]['SP']['Active'] = True
-                self.colonData[timePoint]['SP']['Name'] = nodeName
-                self.colonData[timePoint]['SP']['ID']= nodeID.GetID()
-            if nodeName.endswith("label"):
-                self.colonData[timePoint]['LA']['Active'] = True
-                self.colonData[timePoint]['LA']['Name'] = nodeName
-                self.colonData[timePoint]['LA']['ID']= nodeID.GetID()
-            if nodeName.endswith("Transaxials-threshold"):
-                self.colonData[timePoint]['TH']['Active'] = True
-                self.colonData[timePoint]['TH']['Name'] = nodeName
-                self.colonData[timePoint]['TH']['ID']= nodeID.GetID()
+        for role in ROLES:
+          nodeID = registry.lookup(timePoint, role)
+          self.colonData[timePoint][role]['Active'] = nodeID is not None
+          self.colonData[timePoint][role]['Name'] = registry.name(nodeID) if nodeID else None
+          self.colonData[timePoint][role]['ID'] = nodeID
         if not self.colonData[timePoint]['CT']['Active'] and (not self.colonData[timePoint]['SP']['Active'] and not self.colonData[timePoint]['TH']['Active']):
           print "%s: No CT or SPECT data" % timePoint
      
@@ -647,31 +1181,253 @@ class ColonicAnalysisLogic:
     def setCurrentView(self, view):
       self.currentView = view
       
+    @contextlib.contextmanager
+    def sceneBatch(self):
+      """ Group several scene changes into one update. The scene is put in batch
+          processing state and rendering is paused, nodes passed to batchModify
+          hold back their modified events, and everything is replayed once when
+          the outermost batch ends. Batches may be nested.
+      """
+      self.startSceneBatch()
+      try:
+        yield
+      finally:
+        self.endSceneBatch()
+
+    def startSceneBatch(self):
+      self.batchDepth += 1
+      if self.batchDepth > 1:
+        return
+      slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
+      if hasattr(slicer.app, 'pauseRender'):
+        slicer.app.pauseRender()
+
+    def endSceneBatch(self):
+      self.batchDepth -= 1
+      if self.batchDepth > 0:
+        return
+      nodes = self.batchNodes.values()
+      self.batchNodes = {}
+      for node, wasModifying in nodes:
+        node.EndModify(wasModifying)
+      slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
+      if hasattr(slicer.app, 'resumeRender'):
+        slicer.app.resumeRender()
+      if hasattr(slicer.util, 'forceRenderAllViews'):
+        slicer.util.forceRenderAllViews()
+
+    def batchModify(self, node):
+      """ Hold back the modified events of node until the current sceneBatch ends.
+          Outside a batch the node is returned unchanged.
+      """
+      if self.batchDepth and node and node.GetID() not in self.batchNodes:
+        self.batchNodes[node.GetID()] = (node, node.StartModify())
+      return node
+
+    def addVolume(self, name, array, spacing, origin=None, axes=None, timePoint=None, role=None):
+      """ Add a scalar volume node holding a copy of the [k,j,i] array. origin
+          and axes are the RAS origin and i, j, k unit vectors; without an
+          origin the volume is centred. timePoint and role tag the node for
+          the node registry.
+      """
+      imageData = vtk.vtkImageData()
+      imageData.SetDimensions(array.shape[2], array.shape[1], array.shape[0])
+      imageData.AllocateScalars(VTK_SCALAR_TYPES[array.dtype.newbyteorder('=')], 1)
+      displayNode = slicer.vtkMRMLScalarVolumeDisplayNode()
+      displayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeGrey')
+      slicer.mrmlScene.AddNode(displayNode)
+      volumeNode = slicer.vtkMRMLScalarVolumeNode()
+      volumeNode.SetName(name)
+      volumeNode.SetSpacing(spacing)
+      if axes:
+        directions = vtk.vtkMatrix4x4()
+        for axis, vector in enumerate(axes):
+          for component in range(3):
+            directions.SetElement(component, axis, vector[component])
+        volumeNode.SetIJKToRASDirectionMatrix(directions)
+      if origin:
+        volumeNode.SetOrigin(origin)
+      if timePoint and role:
+        volumeNode.SetAttribute(TIMEPOINT_ATTRIBUTE, timePoint)
+        volumeNode.SetAttribute(ROLE_ATTRIBUTE, role)
+        volumeNode.SetAttribute(TAGGED_NAME_ATTRIBUTE, name)
+      volumeNode.SetAndObserveImageData(imageData)
+      volumeNode.SetAndObserveDisplayNodeID(displayNode.GetID())
+      slicer.mrmlScene.AddNode(volumeNode)
+      slicer.util.array(volumeNode.GetID())[:] = array
+      imageData.Modified()
+      if not origin:
+        self.volumesLogic.CenterVolume(volumeNode)
+      return volumeNode
+
+    def tagVolume(self, volumeNode, timePoint, role):
+      """ Tag a volume the module made with its timepoint and role. Clones
+          inherit the tags of their source, so they must be retagged.
+      """
+      volumeNode.SetAttribute(TIMEPOINT_ATTRIBUTE, timePoint)
+      volumeNode.SetAttribute(ROLE_ATTRIBUTE, role)
+      volumeNode.SetAttribute(TAGGED_NAME_ATTRIBUTE, volumeNode.GetName())
+      self.getNodeRegistry().refresh(volumeNode)
+
+    def loadDicomStudy(self, directory):
+      """ Load the SPECT and CTAC series of every timepoint below directory with
+          their geometry set up front, see ColonicAnalysisLib.Dicom. The
+          volumes are tagged with timepoint and role, so they are found
+          without relying on their names, and need no fixVolumes.
+          Returns the new volume nodes.
+      """
+      volumes = loadDicomStudy(directory, self.timepoints, self.dicomHeaderCache, self.maxWorkers)
+      nodes = []
+      with self.sceneBatch():
+        for volume in volumes:
+          node = self.addVolume(volume['name'], volume['array'], volume['spacing'], volume['origin'],
+                                volume['axes'], volume['timepoint'], volume['role'])
+          node.SetAttribute(GEOMETRY_ATTRIBUTE, "1")
+          node.SetAttribute(SOURCE_ATTRIBUTE, directory)
+          nodes.append(node)
+        self.updateActiveVolumes()
+        self.setVolumeAttributes()
+        self.setSpectColours()
+        self.setCTWindow()
+      return nodes
+
+    def sourceReference(self, timePoint, role):
+      """ How to find the role volume of timePoint again without copying it:
+          its name, the file or DICOM study directory it came from, and its
+          shape and geometry.
+      """
+      node = slicer.util.getNode(self.colonData[timePoint][role]['ID'])
+      storageNode = node.GetStorageNode()
+      directions = vtk.vtkMatrix4x4()
+      node.GetIJKToRASDirectionMatrix(directions)
+      return {'name': node.GetName(),
+              'fileName': storageNode.GetFileName() if storageNode else None,
+              'dicomDirectory': node.GetAttribute(SOURCE_ATTRIBUTE),
+              'shape': list(slicer.util.array(node.GetID()).shape),
+              'spacing': list(node.GetSpacing()),
+              'origin': list(node.GetOrigin()),
+              'directions': [[directions.GetElement(r, c) for c in range(3)] for r in range(3)]}
+
+    def saveSnapshot(self, fileName):
+      """ Save the state of the study in progress to fileName: the thresholds,
+          references to the SPECT and CT volumes and the painted label maps,
+          see ColonicAnalysisLib.Workspace.
+      """
+      state = {'currentView': self.currentView, 'thresholdPreview': self.thresholdPreview, 'timepoints': {}}
+      labels = {}
+      for tp in self.timepoints:
+        cvt = self.colonData[tp]
+        if not cvt['SP']['Active']:
+          continue
+        state['timepoints'][tp] = {
+          'threshold': dict((key, np.asarray(value).item()) for key, value in cvt['Threshold'].items()),
+          'sources': dict((role, self.sourceReference(tp, role)) for role in ('CT', 'SP') if cvt[role]['Active'])}
+        if cvt['LA']['Active']:
+          labels[tp] = slicer.util.array(cvt['LA']['ID'])
+      writeSnapshot(fileName, state, labels)
+
+    def loadSource(self, timePoint, role, source):
+      """ Load a volume saved by reference from its file with its saved geometry.
+          Returns the node, or None if the file is not there.
+      """
+      fileName = source['fileName']
+      if not fileName or not os.path.exists(fileName):
+        return None
+      success, node = slicer.util.loadVolume(fileName, returnNode=True)
+      if not success:
+        return None
+      node.SetName(source['name'])
+      node.SetSpacing(source['spacing'])
+      node.SetOrigin(source['origin'])
+      directions = vtk.vtkMatrix4x4()
+      for r in range(3):
+        for c in range(3):
+          directions.SetElement(r, c, source['directions'][r][c])
+      node.SetIJKToRASDirectionMatrix(directions)
+      node.SetAttribute(GEOMETRY_ATTRIBUTE, "1")
+      self.tagVolume(node, timePoint, role)
+      return node
+
+    def restoreSnapshot(self, fileName):
+      """ Rebuild the study saved by saveSnapshot. Source volumes already in the
+          scene are used as they are, others are loaded again from their file
+          or DICOM study. The threshold volumes are made from the saved
+          thresholds and the label maps filled in.
+          Returns the names of the source volumes that could not be found.
+      """
+      state, labels = readSnapshot(fileName)
+      timePoints = [tp for tp in self.timepoints if tp in state['timepoints']]
+      missing = []
+      with self.sceneBatch():
+        self.updateActiveVolumes()
+        directories = set()
+        for tp in timePoints:
+          for role, source in state['timepoints'][tp]['sources'].items():
+            if not self.colonData[tp][role]['Active'] and not source['fileName'] and source['dicomDirectory']:
+              directories.add(source['dicomDirectory'])
+        for directory in sorted(directories):
+          if os.path.isdir(directory):
+            self.loadDicomStudy(directory)
+        for tp in timePoints:
+          for role, source in state['timepoints'][tp]['sources'].items():
+            if not self.colonData[tp][role]['Active'] and not self.loadSource(tp, role, source):
+              missing.append(source['name'])
+        self.updateActiveVolumes()
+        for tp in timePoints:
+          cvt = self.colonData[tp]
+          if not cvt['SP']['Active']:
+            continue
+          cvt['Threshold'].update(state['timepoints'][tp]['threshold'])
+          if cvt['TH']['Active']:
+            self.applyThreshold(tp, cvt['Threshold']['val'])
+          elif tp in labels or not self.thresholdPreview:
+            self.materialiseThreshold(tp)
+          else:
+            self.previewThreshold(tp, cvt['Threshold']['val'])
+          if tp not in labels:
+            continue
+          self.setupPaint(tp)
+          arrayl = slicer.util.array(cvt['LA']['ID'])
+          if arrayl.shape != labels[tp].shape:
+            print "Snapshot labels of %s do not match the volume" % tp
+            continue
+          arrayl[:] = labels[tp]
+          slicer.util.getNode(cvt['LA']['ID']).GetImageData().Modified()
+      if state['currentView'] in timePoints:
+        self.currentView = state['currentView']
+      return missing
+
     def fixVolumes(self):
       """ The current DICOM import does not load the z spacing correctly for SPECT images.
           This function copies x size to z size and also corrects an orientation issue.
+          Volumes from loadDicomStudy and volumes fixed before are left alone.
       """
       self.updateActiveVolumes()
       self.labelStats = {}
       self.labelStats['Labels'] = []
+      self.labelRecords = None
       self.totalCounts = 0
       self.currentView = self.getActiveSpects()[0]
       self.computedMean = 0.0
       layoutManager = slicer.app.layoutManager()
-      for timePoint in self.colonData:
-        if self.colonData[timePoint]['SP']['Active']:
-          volumeNode = slicer.util.getNode(self.colonData[timePoint]['SP']['ID'])
-          mymat = vtk.vtkMatrix4x4()
-          (sx,sy,sz) = volumeNode.GetSpacing()
-          sz = sx
-          volumeNode.SetSpacing(sx,sy,sz)
-          volumeNode.GetIJKToRASDirectionMatrix(mymat)
-          mymat.SetElement(2,2,-1.0)
-          volumeNode.SetIJKToRASDirectionMatrix(mymat)
-          self.volumesLogic.CenterVolume(volumeNode)
-      self.setSpectColours()
-      self.setCTWindow()
-      layoutManager.setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpView)     
+      with self.sceneBatch():
+        for timePoint in self.colonData:
+          if self.colonData[timePoint]['SP']['Active']:
+            volumeNode = self.batchModify(slicer.util.getNode(self.colonData[timePoint]['SP']['ID']))
+            if volumeNode.GetAttribute(GEOMETRY_ATTRIBUTE):
+              continue
+            volumeNode.SetAttribute(GEOMETRY_ATTRIBUTE, "1")
+            mymat = vtk.vtkMatrix4x4()
+            (sx,sy,sz) = volumeNode.GetSpacing()
+            sz = sx
+            volumeNode.SetSpacing(sx,sy,sz)
+            volumeNode.GetIJKToRASDirectionMatrix(mymat)
+            mymat.SetElement(2,2,-1.0)
+            volumeNode.SetIJKToRASDirectionMatrix(mymat)
+            self.volumesLogic.CenterVolume(volumeNode)
+        self.setSpectColours()
+        self.setCTWindow()
+        layoutManager.setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpView)     
 
 
     def setSpectColours(self):
@@ -680,7 +1436,7 @@ class ColonicAnalysisLogic:
       for timePoint in self.colonData:
         if self.colonData[timePoint]['SP']['Active']:
           volumeNode = slicer.util.getNode(self.colonData[timePoint]['SP']['ID'])
-          displayNode = volumeNode.GetDisplayNode()
+          displayNode = self.batchModify(volumeNode.GetDisplayNode())
           displayNode.SetAndObserveColorNodeID("vtkMRMLColorTableNode"+self.colonData[timePoint]['Colour'])
 
     def setCTWindow(self):
@@ -689,7 +1445,7 @@ class ColonicAnalysisLogic:
       for timePoint in self.colonData:
         if self.colonData[timePoint]['CT']['Active']:
           volumeNode = slicer.util.getNode(self.colonData[timePoint]['CT']['ID'])
-          displayNode = volumeNode.GetDisplayNode()
+          displayNode = self.batchModify(volumeNode.GetDisplayNode())
           displayNode.SetAutoWindowLevel(0)
           displayNode.SetWindowLevel(350.0, 40.0)
       
@@ -698,36 +1454,35 @@ class ColonicAnalysisLogic:
       """ The auto level is incorrectly set to a very small valuefor some SPECT volumes.
           If the level is below 1/3 the window width, set it to 1/2 window width.
       """
-      for timePoint in self.colonData:
-        if self.colonData[timePoint]['SP']['Active']:
-          volumeNode = slicer.util.getNode(self.colonData[timePoint]['SP']['ID'])
-          displayNode = volumeNode.GetDisplayNode()
-          window = displayNode.GetWindow()
-          level =  displayNode.GetLevel()
-          if window < 50:
-            window = window * 10.0
-            displayNode.SetAutoWindowLevel(0)
-            displayNode.SetWindow(window)
-          if level < (window/3.0):
-            print "Adjust Window Level"
-            displayNode.SetAutoWindowLevel(0)
-            displayNode.SetLevel(window/2.0)
+      with self.sceneBatch():
+        for timePoint in self.colonData:
+          if self.colonData[timePoint]['SP']['Active']:
+            volumeNode = slicer.util.getNode(self.colonData[timePoint]['SP']['ID'])
+            displayNode = self.batchModify(volumeNode.GetDisplayNode())
+            window = displayNode.GetWindow()
+            level =  displayNode.GetLevel()
+            if window < 50:
+              window = window * 10.0
+              displayNode.SetAutoWindowLevel(0)
+              displayNode.SetWindow(window)
+            if level < (window/3.0):
+              print "Adjust Window Level"
+              displayNode.SetAutoWindowLevel(0)
+              displayNode.SetLevel(window/2.0)
         
      
     def setVolumeAttributes(self):
-      nodes = slicer.util.getNodes('*HR*')
-      for nodeName, nodeID in nodes.items():
-        if nodeName.find("CTAC") != -1:
-          nodeID.SetAttribute("CT", "1")
-          nodeID.SetAttribute("SelectView", "0")
-        elif nodeName.endswith("Transaxials"):
-          nodeID.SetAttribute("SelectView", "1")
-        elif nodeName.endswith("label"):
-          nodeID.SetAttribute("SelectView", "0")
-        elif nodeName.endswith("threshold"):
-          nodeID.SetAttribute("SelectView", "0")
+      for nodeName, node in self.getNodeRegistry().volumeNodes():
+        if nodeName.find("HR") == -1:
+          continue
+        roles = volumeRoles(nodeName)
+        if 'CT' in roles:
+          node.SetAttribute("CT", "1")
+          node.SetAttribute("SelectView", "0")
+        elif 'SP' in roles:
+          node.SetAttribute("SelectView", "1")
         else:
-          nodeID.SetAttribute("SelectView", "0")
+          node.SetAttribute("SelectView", "0")
       
     def view6hr(self):
         appLogic = slicer.app.applicationLogic()
@@ -758,6 +1513,8 @@ class ColonicAnalysisLogic:
       setLabel = False
       self.labelStats = {}
       self.labelStats['Labels'] = []
+      self.labelRecords = None
+      self.bootstrapIntervals = None
       self.totalCounts = 0
       self.computedMean = 0.0
       appLogic = slicer.app.applicationLogic()
@@ -817,17 +1574,9 @@ class ColonicAnalysisLogic:
         
       
     def getColonNodes(self, timePoint):
-        colonNodes = dict(CT=None, SPECT=None, LABEL=None, THRESHOLD=None)
-        nodes = slicer.util.getNodes('*%s*' % timePoint)
-        for nodeName, nodeID in nodes.items():
-            if nodeName.find("CTAC") != -1:
-                colonNodes['CT'] = nodeID.GetID()
-            if nodeName.endswith("Transaxials"):
-                colonNodes['SPECT'] = nodeID.GetID()
-            if nodeName.endswith("label"):
-                colonNodes['LABEL'] = nodeID.GetID()
-            if nodeName.endswith("threshold"):
-                colonNodes['THRESHOLD'] = nodeID.GetID()
+        registry = self.getNodeRegistry()
+        colonNodes = dict(CT=registry.lookup(timePoint, 'CT'), SPECT=registry.lookup(timePoint, 'SP'),
+                          LABEL=registry.lookup(timePoint, 'LA'), THRESHOLD=registry.lookup(timePoint, 'TH'))
         if colonNodes['CT'] == None and (colonNodes['SPECT'] == None and colonNodes['THRESHOLD'] == None):
             print "No CT or SPECT data!"
         return colonNodes
@@ -836,24 +1585,91 @@ class ColonicAnalysisLogic:
     def calculateThreshold(self, timePoint):
       """ Calculate a threshold value to remove background from SPECT.
       """
-      print "calculateThreshold(%s)" % timePoint
-      cvt = self.colonData[timePoint]
-      arrayv = slicer.util.array(cvt['SP']['ID'])
-      volumeNode = slicer.util.getNode(cvt['SP']['ID'])
-      cvt['Threshold']['max'] = arrayv.max()
-      myVals, myLimits = np.histogram(arrayv, bins = 100)
-      cvt['Threshold']['val'] = myLimits[9]
-      print("%d, %d" % (cvt['Threshold']['val'], cvt['Threshold']['max']))
-      volName = cvt['SP']['Name']
-      if cvt['TH']['Active']:
-        outputVolume = slicer.util.getNode(cvt['TH']['ID'])
-      else:
-        outputVolume = self.volumesLogic.CloneVolume(slicer.mrmlScene, volumeNode, volName+'-threshold')
+      return self.calculateThresholds([timePoint])[0]
+
+    def calculateThresholds(self, timePoints):
+      """ Calculate the background thresholds for several timepoints at once.
+          The histograms and sorted voxel indexes are computed on the thread
+          pool, the threshold volumes are then cloned on the main thread.
+      """
+      print "calculateThresholds(%s)" % ", ".join(timePoints)
+      arrays = [slicer.util.array(self.colonData[tp]['SP']['ID']) for tp in timePoints]
+      cached = [self.cachedHistogram(tp) for tp in timePoints]
+      def analyse(job):
+        arrayv, hist = job
+        if hist is None:
+          hist = VolumeHistogram(arrayv)
+        return hist, buildThresholdIndex(arrayv)
+      results = runParallel(analyse, zip(arrays, cached), self.maxWorkers)
+      cloned = False
+      with self.sceneBatch():
+        for tp, (hist, index) in zip(timePoints, results):
+          cvt = self.colonData[tp]
+          self.histogramCache[cvt['SP']['ID']] = (self.histogramMTime(tp), hist)
+          self.thresholdIndex[cvt['SP']['ID']] = (self.histogramMTime(tp), index)
+          cvt['Threshold']['max'] = hist.maximum
+          cvt['Threshold']['val'] = backgroundThreshold(hist)
+          print("%d, %d" % (cvt['Threshold']['val'], cvt['Threshold']['max']))
+          if not cvt['TH']['Active'] and not self.thresholdPreview:
+            self.cloneThresholdVolume(tp, hist)
+            cloned = True
+      if cloned:
         self.updateActiveVolumes()
-      return cvt['Threshold']['val']
-        
+      return [self.colonData[tp]['Threshold']['val'] for tp in timePoints]
+
+    def histogramMTime(self, timePoint):
+      return slicer.util.getNode(self.colonData[timePoint]['SP']['ID']).GetImageData().GetMTime()
+
+    def cachedHistogram(self, timePoint):
+      """ Return the cached SPECT histogram for timePoint, or None if there is
+          none or the image data has been modified since it was computed.
+      """
+      cached = self.histogramCache.get(self.colonData[timePoint]['SP']['ID'])
+      if cached and cached[0] == self.histogramMTime(timePoint):
+        return cached[1]
+      return None
+
+    def cachedThresholdIndex(self, timePoint):
+      """ Return the threshold index of the SPECT volume for timePoint, or None if
+          there is none or the image data has been modified since it was built.
+          The voxels it records as applied are forgotten unless the -threshold
+          volume is still the one it was last applied to.
+      """
+      cvt = self.colonData[timePoint]
+      cached = self.thresholdIndex.get(cvt['SP']['ID'])
+      if not cached or cached[0] != self.histogramMTime(timePoint):
+        return None
+      index = cached[1]
+      if index['applied'] is not None and index.get('target') != self.thresholdTarget(timePoint):
+        index['applied'] = None
+      return index
+
+    def thresholdTarget(self, timePoint):
+      """ The -threshold volume of timePoint as (node ID, image data modified time).
+      """
+      cvt = self.colonData[timePoint]
+      outputVolume = slicer.util.getNode(cvt['TH']['ID']) if cvt['TH']['Active'] else None
+      if not outputVolume or not outputVolume.GetImageData():
+        return None
+      return (outputVolume.GetID(), outputVolume.GetImageData().GetMTime())
+
+    def getHistogram(self, timePoint):
+      """ Return the histogram of the SPECT volume for timePoint. It is cached per
+          node and rebuilt only when the modified time of the image data changes.
+      """
+      nodeID = self.colonData[timePoint]['SP']['ID']
+      if not self.colonData[timePoint]['SP']['Active'] or nodeID is None:
+        return None
+      hist = self.cachedHistogram(timePoint)
+      if hist is None:
+        hist = VolumeHistogram(slicer.util.array(nodeID))
+        self.histogramCache[nodeID] = (self.histogramMTime(timePoint), hist)
+      return hist
+
     def applyThreshold(self, timePoint, thrsh):
         #print "applyThreshold(%s)" % timePoint
+        if self.thresholdPreview:
+          self.previewThreshold(timePoint, thrsh)
         if not self.colonData[timePoint]['TH']['Active']:
           return
         parameters = {}
@@ -865,19 +1681,180 @@ class ColonicAnalysisLogic:
                 slicer.util.mainWindow(),
                 'Threshold', 'You must run Calculate Threshold first')
             return
-        #print outputVolume.GetName()
+        index = self.cachedThresholdIndex(timePoint)
+        if self.thresholdMode == 'numpy' and self.thresholdArray(volumeNode, outputVolume, thrsh, index):
+          if index:
+            index['target'] = self.thresholdTarget(timePoint)
+          return
+        if index:
+          index['applied'] = None
         parameters['InputVolume'] = volumeNode
         parameters['OutputVolume'] = outputVolume
         parameters['ThresholdValue'] = thrsh
         parameters['ThresholdType'] = 'Below'
         slicer.cli.run(slicer.modules.thresholdscalarvolume, None, parameters, wait_for_completion=True)
         return
+
+    def applyThresholds(self, thresholds):
+      """ Apply a {timePoint: threshold} mapping. In the in-process mode the voxels
+          of all timepoints are thresholded on the thread pool and the modified
+          events are sent afterwards on the main thread.
+      """
+      jobs = []
+      for tp, thrsh in thresholds.items():
+        cvt = self.colonData[tp]
+        if self.thresholdPreview:
+          self.previewThreshold(tp, thrsh)
+        if not cvt['TH']['Active']:
+          continue
+        arrayv = slicer.util.array(cvt['SP']['ID'])
+        arrayt = slicer.util.array(cvt['TH']['ID'])
+        if self.thresholdMode != 'numpy' or arrayv is None or arrayt is None or arrayv.shape != arrayt.shape:
+          self.applyThreshold(tp, thrsh)
+          continue
+        cvt['Threshold']['val'] = thrsh
+        jobs.append((tp, arrayv, arrayt, thrsh, self.cachedThresholdIndex(tp)))
+      changed = runParallel(
+          lambda job: thresholdVoxels(job[1], job[2], job[3], job[4]),
+          jobs, self.maxWorkers)
+      with self.sceneBatch():
+        for job, modified in zip(jobs, changed):
+          if modified:
+            slicer.util.getNode(self.colonData[job[0]]['TH']['ID']).GetImageData().Modified()
+          if job[4]:
+            job[4]['target'] = self.thresholdTarget(job[0])
         
+    def setThresholdPreview(self, enabled):
+      """ In preview mode the threshold is shown by the lower threshold of the
+          SPECT display node, without cloning a -threshold volume or writing
+          any voxels. Leaving preview mode removes the display thresholds and
+          materialises the thresholds calculated so far.
+      """
+      if enabled == self.thresholdPreview:
+        return
+      self.thresholdPreview = enabled
+      with self.sceneBatch():
+        for tp in self.getActiveSpects():
+          if enabled:
+            if self.colonData[tp]['SP']['ID'] in self.thresholdIndex:
+              self.previewThreshold(tp, self.colonData[tp]['Threshold']['val'])
+          else:
+            displayNode = slicer.util.getNode(self.colonData[tp]['SP']['ID']).GetDisplayNode()
+            if displayNode:
+              self.batchModify(displayNode).SetApplyThreshold(0)
+            if self.colonData[tp]['SP']['ID'] in self.thresholdIndex:
+              self.materialiseThreshold(tp)
+
+    def previewThreshold(self, timePoint, thrsh):
+      """ Hide the SPECT voxels of timePoint below thrsh in the slice views.
+      """
+      cvt = self.colonData[timePoint]
+      cvt['Threshold']['val'] = thrsh
+      displayNode = slicer.util.getNode(cvt['SP']['ID']).GetDisplayNode()
+      if not displayNode:
+        return
+      wasModifying = displayNode.StartModify()
+      displayNode.SetLowerThreshold(thrsh)
+      displayNode.SetUpperThreshold(self.getThresholdMax(timePoint))
+      displayNode.SetApplyThreshold(1)
+      displayNode.EndModify(wasModifying)
+
+    def materialiseThreshold(self, timePoint):
+      """ Create the -threshold volume of timePoint at its current threshold
+          if preview mode has not made one yet.
+      """
+      cvt = self.colonData[timePoint]
+      if cvt['TH']['Active'] or not cvt['SP']['Active']:
+        return
+      volumeNode = slicer.util.getNode(cvt['SP']['ID'])
+      outputVolume = self.cloneThresholdVolume(timePoint, self.getHistogram(timePoint))
+      self.updateActiveVolumes()
+      index = self.cachedThresholdIndex(timePoint)
+      if index:
+        # the index tracks the threshold volume, which starts as a plain copy
+        index['applied'] = None
+      if not self.thresholdArray(volumeNode, outputVolume, cvt['Threshold']['val'], index):
+        self.applyThreshold(timePoint, cvt['Threshold']['val'])
+      elif index:
+        index['target'] = self.thresholdTarget(timePoint)
+
+    def cloneThresholdVolume(self, timePoint, hist):
+      """ Clone the SPECT volume of timePoint as its -threshold volume, stored
+          in the smallest integer type that holds the SPECT values.
+      """
+      cvt = self.colonData[timePoint]
+      volumeNode = slicer.util.getNode(cvt['SP']['ID'])
+      outputVolume = self.volumesLogic.CloneVolume(slicer.mrmlScene, volumeNode, cvt['SP']['Name']+'-threshold')
+      self.tagVolume(outputVolume, timePoint, 'TH')
+      dtype = slicer.util.array(cvt['SP']['ID']).dtype
+      self.compactVolume(outputVolume, compactDtype(min(hist.minimum, 0), hist.maximum, dtype))
+      return outputVolume
+
+    def compactVolume(self, volumeNode, dtype):
+      """ Convert the voxels of volumeNode to dtype if that is smaller than
+          their current type. The caller makes sure the values fit.
+          Returns True if the volume was converted.
+      """
+      dtype = np.dtype(dtype)
+      if dtype.itemsize >= slicer.util.array(volumeNode.GetID()).dtype.itemsize or dtype not in VTK_SCALAR_TYPES:
+        return False
+      cast = vtk.vtkImageCast()
+      cast.SetInputData(volumeNode.GetImageData())
+      cast.SetOutputScalarType(VTK_SCALAR_TYPES[dtype])
+      cast.Update()
+      volumeNode.SetAndObserveImageData(cast.GetOutput())
+      return True
+
+    def memoryReport(self):
+      """ Memory held by the volumes of each timepoint of the study and by the
+          threshold indexes and histograms cached for them, as text.
+      """
+      rows = []
+      for tp in self.timepoints:
+        cvt = self.colonData[tp]
+        for role in ROLES:
+          if cvt[role]['Active']:
+            arrayv = slicer.util.array(cvt[role]['ID'])
+            if arrayv is not None:
+              rows.append((tp, role, "%s %s" % (cvt[role]['Name'], arrayv.dtype), arrayv.nbytes))
+        index = self.thresholdIndex.get(cvt['SP']['ID'])
+        if index:
+          index = index[1]
+          rows.append((tp, 'index', "threshold index", index['order'].nbytes + index['values'].nbytes))
+        cached = self.histogramCache.get(cvt['SP']['ID'])
+        if cached:
+          hist = cached[1]
+          rows.append((tp, 'histogram', "SPECT histogram", hist.counts.nbytes + hist.cumCounts.nbytes + hist.cumWeights.nbytes))
+      cache = self.statsCache
+      rows.append(('Stats cache', 'memory', "%d entries" % len(cache.entries),
+                   sum(sum(np.asarray(stats[field]).nbytes for field in stats) for stats in cache.entries.values())))
+      rows.append(('Stats cache', 'disk', cache.directory or "none", cache.diskBytes()))
+      if self.liveStats:
+        tracker = self.liveStats['tracker']
+        rows.append((self.liveStats['timePoint'], 'live', "live statistics label copy",
+                     tracker.shadow.nbytes + tracker.changed.nbytes))
+      return formatMemoryReport(rows)
+
+    def thresholdArray(self, volumeNode, outputVolume, thrsh, index=None):
+      """ Threshold volumeNode into the existing outputVolume array in-process.
+          Returns False if the arrays do not match so the caller can use the CLI.
+      """
+      arrayv = slicer.util.array(volumeNode.GetID())
+      arrayt = slicer.util.array(outputVolume.GetID())
+      if arrayv is None or arrayt is None or arrayv.shape != arrayt.shape:
+        return False
+      if thresholdVoxels(arrayv, arrayt, thrsh, index):
+        outputVolume.GetImageData().Modified()
+      return True
+
     def getThreshold(self, timepoint):
       return self.colonData[timepoint]['Threshold']['val']
       
     def getThresholdMax(self, timepoint):
-      return self.colonData[timepoint]['Threshold']['max']
+      hist = self.getHistogram(timepoint)
+      if hist is None:
+        return self.colonData[timepoint]['Threshold']['max']
+      return hist.maximum
       
       
     def volumeCount(self):
@@ -891,65 +1868,179 @@ class ColonicAnalysisLogic:
       selectionNode.SetReferenceActiveVolumeID( nodes[names[index]].GetID() )
       slicer.app.applicationLogic().PropagateVolumeSelection(0)
         
+    def labelStatisticsForTimepoints(self, timePoints):
+      """ Return {timePoint: labelStatistics} for timepoints with SPECT and label
+          volumes, computed on the thread pool.
+      """
+      timePoints = [tp for tp in timePoints
+                    if self.colonData[tp]['SP']['Active'] and self.colonData[tp]['LA']['Active']]
+      numLabels = len(self.colonRegions)
+      keys = [self.statsCacheKey(tp) for tp in timePoints]
+      results = dict((tp, self.statsCache.get(key)) for tp, key in zip(timePoints, keys))
+      missing = [(tp, key) for tp, key in zip(timePoints, keys) if results[tp] is None]
+      jobs = [(slicer.util.array(self.colonData[tp]['SP']['ID']),
+               slicer.util.array(self.colonData[tp]['LA']['ID'])) for tp, key in missing]
+      computed = runParallel(lambda job: labelStatistics(job[0], job[1], numLabels, self.statsMemoryBudget),
+                             jobs, self.maxWorkers)
+      for (tp, key), stats in zip(missing, computed):
+        self.statsCache.put(key, stats)
+        results[tp] = stats
+      return results
+
+    def statsCacheKey(self, timePoint):
+      """ The statsKey of the SPECT and label volumes of timePoint. It is
+          hashed again only when the modified time of either image data changes.
+      """
+      cvt = self.colonData[timePoint]
+      spectNode = slicer.util.getNode(cvt['SP']['ID'])
+      labelNode = slicer.util.getNode(cvt['LA']['ID'])
+      nodeIDs = (spectNode.GetID(), labelNode.GetID())
+      mtimes = (spectNode.GetImageData().GetMTime(), labelNode.GetImageData().GetMTime())
+      known = self.statsKeys.get(nodeIDs)
+      if known and known[0] == mtimes:
+        return known[1]
+      key = statsKey(slicer.util.array(nodeIDs[0]), slicer.util.array(nodeIDs[1]),
+                     spectNode.GetSpacing(), len(self.colonRegions))
+      self.statsKeys[nodeIDs] = (mtimes, key)
+      return key
+
+    def computeTransitTable(self):
+      """ Per label counts and the geometric centre of every timepoint with SPECT
+          and label volumes. The statistics of each timepoint come from the
+          stats cache where possible, see labelStatisticsForTimepoints.
+          Returns (timePoints, transit, spacings), see stackStatistics.
+      """
+      timePoints = [tp for tp in self.timepoints
+                    if self.colonData[tp]['SP']['Active'] and self.colonData[tp]['LA']['Active']]
+      stats = self.labelStatisticsForTimepoints(timePoints)
+      spacings = [slicer.util.getNode(self.colonData[tp]['SP']['ID']).GetSpacing() for tp in timePoints]
+      transit = stackStatistics([stats[tp] for tp in timePoints])
+      return timePoints, transit, spacings
+
+    def transitTableAsCSV(self):
+      timePoints, transit, spacings = self.computeTransitTable()
+      return transitTableAsCSV(transit, timePoints, spacings)
+
+    def thresholdSweep(self, timePoints, thresholds=None):
+      """ Return {timePoint: thresholdSweep} for timepoints with SPECT and label
+          volumes, computed on the thread pool. Without thresholds each
+          timepoint is swept from 0 to three times its current threshold,
+          see sweepThresholds.
+      """
+      timePoints = [tp for tp in timePoints
+                    if self.colonData[tp]['SP']['Active'] and self.colonData[tp]['LA']['Active']]
+      jobs = []
+      for tp in timePoints:
+        tpThresholds = thresholds
+        if tpThresholds is None:
+          tpThresholds = sweepThresholds(self.getThreshold(tp), self.getThresholdMax(tp))
+        jobs.append((slicer.util.array(self.colonData[tp]['SP']['ID']),
+                     slicer.util.array(self.colonData[tp]['LA']['ID']), tpThresholds))
+      numLabels = len(self.colonRegions)
+      results = runParallel(lambda job: thresholdSweep(job[0], job[1], numLabels, job[2]), jobs, self.maxWorkers)
+      return dict(zip(timePoints, results))
+
+    def thresholdSweepAsCSV(self, thresholds=None):
+      sweeps = self.thresholdSweep(self.timepoints, thresholds)
+      timePoints = [tp for tp in self.timepoints if tp in sweeps]
+      spacings = [slicer.util.getNode(self.colonData[tp]['SP']['ID']).GetSpacing() for tp in timePoints]
+      return sweepAsCSV([sweeps[tp] for tp in timePoints], timePoints, spacings)
+
+    def startLiveStats(self, timePoint, callback=None):
+      """ Keep the label statistics of timePoint up to date while its label volume
+          is painted. The modifications of the label volume are gathered for
+          one frame, then only the changed block is recounted, labelStats
+          filled and callback(timePoint) called.
+      """
+      self.stopLiveStats()
+      cvt = self.colonData[timePoint]
+      labelNode = slicer.util.getNode(cvt['LA']['ID'])
+      event = getattr(slicer.vtkMRMLVolumeNode, 'ImageDataModifiedEvent', vtk.vtkCommand.ModifiedEvent)
+      self.liveStats = {
+        'timePoint': timePoint,
+        'node': labelNode,
+        'spacing': slicer.util.getNode(cvt['SP']['ID']).GetSpacing(),
+        'tracker': LabelStatsTracker(slicer.util.array(cvt['SP']['ID']),
+                                     slicer.util.array(cvt['LA']['ID']), len(self.colonRegions)),
+        'callback': callback,
+        'tag': labelNode.AddObserver(event, self.onLiveLabelModified)}
+      self.updateLiveStats(force=True)
+
+    def stopLiveStats(self):
+      self.liveStatsTimer.stop()
+      if self.liveStats:
+        self.liveStats['node'].RemoveObserver(self.liveStats['tag'])
+        self.liveStats = None
+
+    def onLiveLabelModified(self, caller, event):
+      # finding the changed block compares the whole label volume, so it is
+      # done once per frame rather than for every modified event of a stroke
+      if not self.liveStatsTimer.isActive():
+        self.liveStatsTimer.start()
+
+    def updateLiveStats(self, extent=None, force=False):
+      """ Recount the label statistics for the painted extent (i0, i1, j0, j1, k0, k1)
+          or, if that is not known, for the block that differs from the last update.
+      """
+      live = self.liveStats
+      if not live:
+        return
+      arrayl = slicer.util.array(live['node'].GetID())
+      tracker = live['tracker']
+      if arrayl.shape != tracker.shadow.shape:
+        self.startLiveStats(live['timePoint'], live['callback'])
+        return
+      if not tracker.update(arrayl, extent) and not force:
+        return
+      stats = tracker.stats()
+      self.labelStats, self.totalCounts, self.computedMean = statsTable(stats, live['spacing'])
+      self.labelRecords = statsRecords(stats, live['spacing'])
+      self.bootstrapIntervals = None
+      if live['callback']:
+        live['callback'](live['timePoint'])
+
     def computeMean(self, timePoint):
-      import numpy.ma as ma
-      cvt = self.colonData[self.currentView]
-      arrayv = slicer.util.array(cvt['SP']['ID'])
-      arrayl = slicer.util.array(cvt['LA']['ID'])
-      cubicMMPerVoxel = reduce(lambda x,y: x*y, slicer.util.getNode(cvt['SP']['ID']).GetSpacing())
-      #arrayv = slicer.util.array(nodes['SPECT'])
-      #arrayl = slicer.util.array(nodes['LABEL'])
-      #cubicMMPerVoxel = reduce(lambda x,y: x*y, slicer.util.getNode(nodes['LABEL']).GetSpacing())
-      ccPerCubicMM = 0.001
-      #ma.masked_array(arrayv, (arrayl != 2)).sum()
-      #totalCounts = 0
-      roiCounts = [0]
-      for i in range(1,len(self.colonRegions)):
-          self.labelStats["Labels"].append(i)
-          self.labelStats[i,"Label"] = i
-          self.labelStats[i,"Voxels"] = 0
-          self.labelStats[i,"Total Counts"] = 0
-          if (arrayl == i).any():
-              maskedArray = ma.masked_array(arrayv, (arrayl != i))
-              self.labelStats[i,"Voxels"] = (maskedArray > 0).sum()
-              myCounts = maskedArray.sum()
-              self.labelStats[i,"Total Counts"] = myCounts
-              roiCounts.append(myCounts)
-              self.totalCounts += myCounts
-          else:
-              roiCounts.append(0)
-          self.labelStats[i,"Volume cc"] = "%2.3f" % (self.labelStats[i,"Voxels"] * cubicMMPerVoxel * ccPerCubicMM)
-      #computedMean = 0.0
-      for i in range(len(roiCounts)):
-          sm = 0;
-          if self.totalCounts:
-            sm = (float(roiCounts[i])/float(self.totalCounts))*float(i)
-          self.labelStats[i,"SPECT Mean"] = "%2.3f" % sm
-          self.computedMean += sm
+      cvt = self.colonData[timePoint]
+      spacing = slicer.util.getNode(cvt['SP']['ID']).GetSpacing()
+      stats = self.labelStatisticsForTimepoints([timePoint])[timePoint]
+      self.labelStats, self.totalCounts, self.computedMean = statsTable(stats, spacing)
+      self.labelRecords = statsRecords(stats, spacing)
+      self.bootstrapIntervals = self.bootstrapStatistics(stats['counts']) if self.confidenceIntervals else None
+
+    def bootstrapStatistics(self, counts):
+      """ Poisson bootstrap intervals of per label counts with the module's
+          resample count, confidence and seed, see ColonicAnalysisLib.Bootstrap.
+      """
+      return bootstrapStatistics(counts, self.bootstrapResamples, self.bootstrapConfidence,
+                                 self.bootstrapSeed, maxWorkers=self.maxWorkers)
+
+    def intervalsAsCSV(self):
+      timePoints, transit, spacings = self.computeTransitTable()
+      intervals = [self.bootstrapStatistics(counts) for counts in transit['counts']]
+      return intervalsAsCSV(transit, intervals, timePoints)
         
     def statsAsCSV(self):
       """
       print comma separated value file with header keys in quotes
       """
-      csv = ""
-      header = ""
-      for k in self.keys[:-1]:
-        header += "\"%s\"" % k + ","
-      header += "\"%s\"" % self.keys[-1] + "\n"
-      csv = header
-      for i in self.labelStats["Labels"]:
-        line = ""
-        for k in self.keys[:-1]:
-          line += str(self.labelStats[i,k]) + ","
-        line += str(self.labelStats[i,self.keys[-1]]) + "\n"
-        csv += line
-      return csv
+      return statsAsCSV(self.labelStats, self.keys)
 
     def saveStats(self,fileName):
-      fp = open(fileName, "w")
-      fp.write(self.statsAsCSV())
-      fp.close()
+      """ Save the statistics of every timepoint with SPECT and label volumes,
+          with the totals and geometric centre. The format follows the file
+          extension, see saveStatsFile.
+      """
+      timePoints, transit, spacings = self.computeTransitTable()
+      records, summary = transitRecords(transit, timePoints, spacings)
+      saveStatsFile(fileName, records, summary)
       
+    def createLabels(self, timePoints):
+      """ Create the label volumes for timePoints in one scene batch.
+      """
+      with self.sceneBatch():
+        for tp in timePoints:
+          self.setupPaint(tp)
+
     def setupPaint(self, timePoint):
       print ("setupPaint()")
       if not self.hasColourtable:
@@ -959,12 +2050,16 @@ class ColonicAnalysisLogic:
           return
       if self.colonData[timePoint]['LA']['Active']:
         return
+      if self.thresholdPreview:
+        self.materialiseThreshold(timePoint)
       applicationLogic = slicer.app.applicationLogic()
       volumesLogic = slicer.modules.volumes.logic()
       colorLogic = slicer.modules.colors.logic()
       if self.colonData[timePoint]['TH']['Active']:
         volumeNode = slicer.util.getNode(self.colonData[timePoint]['TH']['ID'])
         labelNode = volumesLogic.CreateAndAddLabelVolume(volumeNode, volumeNode.GetName()+'-label')
+        self.tagVolume(labelNode, timePoint, 'LA')
+        self.compactVolume(labelNode, LABEL_DTYPE)
         labelNode.GetDisplayNode().SetAndObserveColorNodeID('vtkMRMLColorTableNodeFileColonColors.txt')
         self.updateActiveVolumes()
 
@@ -1001,6 +2096,15 @@ class ColonicAnalysisTest(unittest.TestCase):
     """
     self.setUp()
     self.test_ColonicAnalysis1()
+    self.test_StatsKeys()
+    self.test_Snapshot()
+    self.test_Phantom()
+    self.test_Profiling()
+    self.test_ThresholdPreview()
+    self.test_ThresholdIndexNewVolume()
+    self.test_ChangeViewKeepsThresholds()
+    self.test_RegistryIgnoresCopies()
+    self.test_DicomLoader()
 
   def test_ColonicAnalysis1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -1063,3 +2167,257 @@ class ColonicAnalysisTest(unittest.TestCase):
       raise Exception("Volume ID was not selected!\nExpected %s but got %s" % (lastVolumeID, selectedID))
 
     self.delayDisplay('Test passed!')
+
+  def test_StatsKeys(self):
+    """ The statistics cache keys of a node are dropped when it leaves the scene.
+    """
+    from ColonicAnalysisLib.Benchmark import makePhantom, phantomVolumeNames
+    logic = ColonicAnalysisLogic()
+    timePoint = TIMEPOINTS[0]
+    phantom = makePhantom(16)
+    spectNode = logic.addVolume(phantomVolumeNames(timePoint)['SP'], phantom['SP'], phantom['spacing'])
+    labelNode = logic.addVolume(phantomVolumeNames(timePoint)['LA'], phantom['LA'], phantom['spacing'])
+    logic.updateActiveVolumes()
+    logic.computeMean(timePoint)
+    self.assertEqual(list(logic.statsKeys), [(spectNode.GetID(), labelNode.GetID())])
+    slicer.mrmlScene.RemoveNode(labelNode)
+    self.assertEqual(logic.statsKeys, {})
+    slicer.mrmlScene.RemoveNode(spectNode)
+    logic.cleanup()
+
+  def test_Snapshot(self):
+    """ A snapshot restores the thresholds and labels into an empty scene,
+    loading the SPECT volume again from its file.
+    """
+    from ColonicAnalysisLib.Benchmark import makePhantom, phantomVolumeNames
+    fileName = os.path.join(slicer.app.temporaryPath, 'ColonicAnalysisSnapshotTest.npz')
+    slicer.mrmlScene.Clear(0)
+    logic = ColonicAnalysisLogic()
+    timePoint = TIMEPOINTS[0]
+    phantom = makePhantom(32, countLevel=100)
+    spectNode = logic.addVolume(phantomVolumeNames(timePoint)['SP'], phantom['SP'], phantom['spacing'])
+    self.assertTrue(slicer.util.saveNode(spectNode, os.path.join(slicer.app.temporaryPath, 'ColonicAnalysisSnapshotSP.nrrd')))
+    logic.updateActiveVolumes()
+    logic.calculateThresholds([timePoint])
+    logic.applyThreshold(timePoint, 20)
+    logic.createLabels([timePoint])
+    arrayl = slicer.util.array(logic.colonData[timePoint]['LA']['ID'])
+    arrayl[:] = phantom['LA']
+    logic.saveSnapshot(fileName)
+    logic.cleanup()
+
+    slicer.mrmlScene.Clear(0)
+    logic = ColonicAnalysisLogic()
+    self.assertEqual(logic.restoreSnapshot(fileName), [])
+    cvt = logic.colonData[timePoint]
+    self.assertTrue(cvt['SP']['Active'] and cvt['TH']['Active'] and cvt['LA']['Active'])
+    self.assertEqual(cvt['Threshold']['val'], 20)
+    self.assertTrue(np.array_equal(slicer.util.array(cvt['LA']['ID']), phantom['LA']))
+    thresholded = slicer.util.array(cvt['TH']['ID'])
+    self.assertEqual(thresholded[phantom['SP'] < 20].sum(), 0)
+    logic.cleanup()
+
+  def test_Phantom(self):
+    """ Time the logic hot paths on synthetic phantom studies and check their
+    results against the NumPy core. The timings are written out, not compared:
+    only the headless benchmark has a baseline, see ColonicAnalysisLib.Benchmark.
+    """
+    from ColonicAnalysisLib.Benchmark import phantomVolumeNames, runCases, writeBaseline
+    self.delayDisplay("Starting the phantom benchmark")
+    logic = ColonicAnalysisLogic()
+    timePoint = TIMEPOINTS[0]
+    names = phantomVolumeNames(timePoint)
+
+    def prepare(phantom):
+      state = dict(phantom)
+      spectNode = logic.addVolume(names['SP'], phantom['SP'], phantom['spacing'])
+      logic.addVolume(names['CT'], phantom['CT'], phantom['spacing'])
+      labelNode = logic.volumesLogic.CreateAndAddLabelVolume(spectNode, names['LA'])
+      slicer.util.array(labelNode.GetID())[:] = phantom['LA']
+      labelNode.GetImageData().Modified()
+      return state
+
+    def calculateThreshold(state):
+      state['threshold'] = logic.calculateThreshold(timePoint)
+
+    def finish(state):
+      cvt = logic.colonData[timePoint]
+      stats = labelStatistics(state['SP'], state['LA'], len(COLON_REGIONS))
+      self.assertEqual(logic.totalCounts, stats['total'])
+      self.assertAlmostEqual(logic.computedMean, stats['mean'].sum())
+      expected = np.where(state['SP'] >= state['threshold'], state['SP'], 0)
+      self.assertTrue(np.array_equal(slicer.util.array(cvt['TH']['ID']), expected))
+      for role in ROLES:
+        if cvt[role]['ID']:
+          slicer.mrmlScene.RemoveNode(slicer.util.getNode(cvt[role]['ID']))
+      logic.updateActiveVolumes()
+
+    steps = [('updateActiveVolumes', lambda state: logic.updateActiveVolumes()),
+             ('calculateThreshold', calculateThreshold),
+             ('applyThreshold', lambda state: logic.applyThreshold(timePoint, state['threshold'])),
+             ('computeMean', lambda state: logic.computeMean(timePoint)),
+             ('statsAsCSV', lambda state: logic.statsAsCSV())]
+    cases = [(size, len(COLON_REGIONS) - 1, 1000) for size in (64, 128)]
+    try:
+      results = runCases(cases, steps, prepare, finish)
+    finally:
+      logic.cleanup()
+    fileName = os.path.join(slicer.app.temporaryPath, 'ColonicAnalysisBenchmark.json')
+    writeBaseline(results, fileName, 'slicer')
+    self.delayDisplay("Test passed! Timings written to %s" % fileName)
+
+  def test_Profiling(self):
+    """ Profiled logic calls are recorded and the methods restored afterwards.
+    """
+    logic = ColonicAnalysisLogic()
+    logic.setProfiling(True)
+    logic.updateActiveVolumes()
+    logic.updateActiveVolumes()
+    logic.getActiveSpects()
+    records = logic.profiler.records
+    self.assertEqual(records['updateActiveVolumes']['calls'], 2)
+    self.assertEqual(records['getActiveSpects']['volumesAdded'], 0)
+    self.assertFalse('cleanup' in records)
+    logic.setProfiling(False)
+    self.assertFalse('updateActiveVolumes' in logic.__dict__)
+    logic.updateActiveVolumes()
+    self.assertEqual(logic.profiler.records['updateActiveVolumes']['calls'], 2)
+    logic.cleanup()
+
+  def test_ThresholdPreview(self):
+    """ Preview mode thresholds the SPECT display only, the threshold volume
+    is made when the labels are created.
+    """
+    from ColonicAnalysisLib.Benchmark import makePhantom, phantomVolumeNames
+    logic = ColonicAnalysisLogic()
+    timePoint = TIMEPOINTS[0]
+    phantom = makePhantom(32, countLevel=100)
+    spectNode = logic.addVolume(phantomVolumeNames(timePoint)['SP'], phantom['SP'], phantom['spacing'])
+    logic.updateActiveVolumes()
+    logic.setThresholdPreview(True)
+    thrsh = logic.calculateThreshold(timePoint)
+    logic.applyThreshold(timePoint, thrsh + 1)
+    self.assertFalse(logic.colonData[timePoint]['TH']['Active'])
+    self.assertEqual(spectNode.GetDisplayNode().GetApplyThreshold(), 1)
+    self.assertEqual(spectNode.GetDisplayNode().GetLowerThreshold(), thrsh + 1)
+    logic.createLabels([timePoint])
+    cvt = logic.colonData[timePoint]
+    self.assertTrue(cvt['TH']['Active'] and cvt['LA']['Active'])
+    expected = np.where(phantom['SP'] >= thrsh + 1, phantom['SP'], 0)
+    self.assertTrue(np.array_equal(slicer.util.array(cvt['TH']['ID']), expected))
+    self.assertEqual(slicer.util.array(cvt['TH']['ID']).dtype, compactDtype(0, phantom['SP'].max()))
+    self.assertEqual(slicer.util.array(cvt['LA']['ID']).dtype, LABEL_DTYPE)
+    self.assertTrue(logic.memoryReport().startswith(timePoint))
+    logic.cleanup()
+
+  def test_ThresholdIndexNewVolume(self):
+    """ The threshold index of a SPECT volume is not used once its voxels have
+    changed, and is dropped with the volume.
+    """
+    from ColonicAnalysisLib.Benchmark import makePhantom, phantomVolumeNames
+    logic = ColonicAnalysisLogic()
+    timePoint = TIMEPOINTS[0]
+    first, second = makePhantom(32, countLevel=100), makePhantom(32, countLevel=20, seed=1)
+    spectNode = logic.addVolume(phantomVolumeNames(timePoint)['SP'], first['SP'], first['spacing'])
+    logic.updateActiveVolumes()
+    thrsh = logic.calculateThreshold(timePoint)
+    logic.applyThreshold(timePoint, thrsh + 1)
+    slicer.util.array(spectNode.GetID())[:] = second['SP']
+    spectNode.GetImageData().Modified()
+    logic.applyThreshold(timePoint, 3)
+    expected = np.where(second['SP'] >= 3, second['SP'], 0)
+    self.assertTrue(np.array_equal(slicer.util.array(logic.colonData[timePoint]['TH']['ID']), expected))
+    nodeID = spectNode.GetID()
+    self.assertTrue(nodeID in logic.thresholdIndex)
+    slicer.mrmlScene.RemoveNode(spectNode)
+    self.assertFalse(nodeID in logic.thresholdIndex)
+    logic.cleanup()
+
+  def test_ChangeViewKeepsThresholds(self):
+    """ Switching between views whose thresholds lie above each other's maximum
+    must not change any threshold.
+    """
+    from ColonicAnalysisLib.Benchmark import makePhantom, phantomVolumeNames
+    slicer.mrmlScene.Clear(0)
+    widget = ColonicAnalysisWidget()
+    logic = widget.logic
+    timePoints = TIMEPOINTS[:2]
+    for tp, countLevel in zip(timePoints, (100, 20)):
+      phantom = makePhantom(32, countLevel=countLevel)
+      logic.addVolume(phantomVolumeNames(tp)['SP'], phantom['SP'], phantom['spacing'])
+    logic.updateActiveVolumes()
+    logic.calculateThresholds(timePoints)
+    high, low = timePoints
+    highThreshold = logic.getThresholdMax(low) + 5
+    self.assertTrue(highThreshold < logic.getThresholdMax(high))
+    logic.applyThresholds({high: highThreshold, low: 3})
+    before = slicer.util.array(logic.colonData[high]['TH']['ID']).copy()
+    for view in (low, high, low, high):
+      widget.changeView(view)
+      self.assertEqual(widget.slider.value, logic.getThreshold(view))
+      self.delayDisplay("Showing %s" % view, 100)
+    self.assertEqual(logic.getThreshold(high), highThreshold)
+    self.assertEqual(logic.getThreshold(low), 3)
+    self.assertTrue(np.array_equal(slicer.util.array(logic.colonData[high]['TH']['ID']), before))
+    widget.cleanup()
+    widget.parent.close()
+
+  def test_RegistryIgnoresCopies(self):
+    """ A copy of a tagged volume made outside the module carries its tags but
+    must not take over its timepoint and role.
+    """
+    from ColonicAnalysisLib.Benchmark import makePhantom
+    logic = ColonicAnalysisLogic()
+    timePoint = TIMEPOINTS[0]
+    phantom = makePhantom(16)
+    spectNode = logic.addVolume("NM Transaxials", phantom['SP'], phantom['spacing'], timePoint=timePoint, role='SP')
+    copyNode = logic.addVolume("NM Transaxials_1", phantom['SP'], phantom['spacing'])
+    for attribute in (TIMEPOINT_ATTRIBUTE, ROLE_ATTRIBUTE, TAGGED_NAME_ATTRIBUTE):
+      copyNode.SetAttribute(attribute, spectNode.GetAttribute(attribute))
+    registry = logic.getNodeRegistry()
+    self.assertEqual(registry.lookup(timePoint, 'SP'), spectNode.GetID())
+    logic.tagVolume(copyNode, timePoint, 'SP')
+    self.assertEqual(registry.lookup(timePoint, 'SP'), copyNode.GetID())
+    logic.cleanup()
+
+  def test_DicomLoader(self):
+    """ A synthetic three timepoint study loads with its geometry and tags set.
+    """
+    from ColonicAnalysisLib.Benchmark import makePhantom
+    from ColonicAnalysisLib.Dicom import importPydicom, pixelDtype, writeSyntheticSeries
+    header = {'slope': 1.0, 'intercept': 0.0, 'signed': True, 'bitsStored': 16}
+    self.assertEqual(pixelDtype([header, dict(header, intercept=-1024.0)]), np.int32)
+    self.assertEqual(pixelDtype([header, dict(header, slope=0.5)]), np.float32)
+    try:
+      importPydicom()
+    except ImportError:
+      self.delayDisplay('pydicom is not available, DICOM loader not tested')
+      return
+    directory = os.path.join(slicer.app.temporaryPath, 'ColonicAnalysisDicom')
+    if os.path.isdir(directory):
+      import shutil
+      shutil.rmtree(directory)
+    phantoms = {}
+    for tp in TIMEPOINTS:
+      phantoms[tp] = makePhantom(16, countLevel=100, seed=TIMEPOINTS.index(tp))
+      writeSyntheticSeries(os.path.join(directory, tp, 'NM'), phantoms[tp]['SP'], (4.0, 4.0, 3.5),
+                           '%s Transaxials' % tp, 'NM', (-32.0, -32.0, 30.0))
+      writeSyntheticSeries(os.path.join(directory, tp, 'CT'), phantoms[tp]['CT'], (4.0, 4.0, 2.0),
+                           '%s CTAC' % tp, 'CT', (-32.0, -32.0, 0.0))
+    logic = ColonicAnalysisLogic()
+    nodes = logic.loadDicomStudy(directory)
+    self.assertEqual(len(nodes), 2 * len(TIMEPOINTS))
+    for tp in TIMEPOINTS:
+      cvt = logic.colonData[tp]
+      self.assertTrue(cvt['SP']['Active'] and cvt['CT']['Active'])
+      spectNode = slicer.util.getNode(cvt['SP']['ID'])
+      self.assertEqual(spectNode.GetAttribute(TIMEPOINT_ATTRIBUTE), tp)
+      self.assertEqual(spectNode.GetSpacing(), (4.0, 4.0, 3.5))
+      directions = vtk.vtkMatrix4x4()
+      spectNode.GetIJKToRASDirectionMatrix(directions)
+      self.assertEqual(directions.GetElement(2, 2), -1.0)
+      self.assertTrue(np.array_equal(slicer.util.array(cvt['SP']['ID']), phantoms[tp]['SP']))
+      self.assertEqual(slicer.util.getNode(cvt['CT']['ID']).GetSpacing(), (4.0, 4.0, 2.0))
+    logic.fixVolumes()
+    self.assertEqual(slicer.util.getNode(logic.colonData[TIMEPOINTS[0]]['SP']['ID']).GetSpacing(), (4.0, 4.0, 3.5))
+    logic.cleanup()
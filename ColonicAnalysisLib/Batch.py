@@ -0,0 +1,178 @@
+"""Headless batch runner for the colonic transit workflow.
+
+  python -m ColonicAnalysisLib.Batch manifest.csv outputDir [--workers N] [--fix-spacing] [--max-memory MB]
+
+The manifest is a CSV file with the columns study, timepoint, spect, label
+and optionally ct, one row per study timepoint (6HRS, 24HRS or 32HRS).
+Relative paths are resolved against the manifest directory. The CT is not
+needed for the statistics and is only checked for existence.
+
+Raw NRRD files are memory mapped rather than read, so the statistics only
+load the pages they touch and workers share the page cache.
+Studies are fanned out over a process pool. Each finished study writes a
+checkpoint to outputDir/checkpoints, so an interrupted run skips the studies
+that are already done when it is started again. outputDir/stats.csv is
+rebuilt from the checkpoints at the end, one row per study timepoint.
+"""
+import csv
+import json
+import multiprocessing
+import os
+import re
+import sys
+
+from .LabelStatistics import COLON_REGIONS, CC_PER_CUBIC_MM, labelStatistics, voxelVolume
+from .Naming import TIMEPOINTS
+from .Threshold import VolumeHistogram, backgroundThreshold
+from .VolumeIO import readNrrd, replaceFile
+
+__all__ = ['readManifest', 'analyseTimepoint', 'analyseStudy', 'runBatch', 'statsColumns']
+
+
+def readManifest(fileName):
+  """Read the manifest into a list of (study, rows) in file order"""
+  baseDir = os.path.dirname(os.path.abspath(fileName))
+  studies = []
+  rowsByStudy = {}
+  with open(fileName) as fp:
+    for row in csv.DictReader(fp):
+      row = dict((k.strip().lower(), (v or '').strip()) for k, v in row.items())
+      if row.get('timepoint') not in TIMEPOINTS:
+        raise ValueError("Unknown timepoint %r for study %s" % (row.get('timepoint'), row.get('study')))
+      for key in ('spect', 'label', 'ct'):
+        if row.get(key):
+          row[key] = os.path.join(baseDir, row[key])
+      if row['study'] not in rowsByStudy:
+        rowsByStudy[row['study']] = []
+        studies.append((row['study'], rowsByStudy[row['study']]))
+      rowsByStudy[row['study']].append(row)
+  return studies
+
+
+def statsColumns():
+  columns = ["Study", "Timepoint", "Threshold", "Max", "Total Counts", "Geometric Centre"]
+  for region in COLON_REGIONS[:-1]:
+    columns += ["%s Voxels" % region, "%s Volume cc" % region, "%s Counts" % region]
+  return columns
+
+
+def analyseTimepoint(row, fixSpacing=False, maxBytes=None):
+  """Threshold and label statistics for one manifest row, as a stats row dict.
+  maxBytes bounds the working memory of the histogram and the statistics,
+  see labelStatistics."""
+  arrayv, spacing = readNrrd(row['spect'], mmap=True)
+  arrayl = readNrrd(row['label'], mmap=True)[0]
+  if arrayv.shape != arrayl.shape:
+    raise ValueError("SPECT and label volumes differ in size: %s %s" % (arrayv.shape, arrayl.shape))
+  if row.get('ct') and not os.path.exists(row['ct']):
+    raise IOError("CT volume %s does not exist" % row['ct'])
+  if fixSpacing:
+    spacing = (spacing[0], spacing[1], spacing[0])
+  hist = VolumeHistogram(arrayv, maxBytes=maxBytes)
+  stats = labelStatistics(arrayv, arrayl, len(COLON_REGIONS), maxBytes)
+  cubicMMPerVoxel = voxelVolume(spacing)
+  result = {"Study": row['study'], "Timepoint": row['timepoint'],
+            "Threshold": float(backgroundThreshold(hist)), "Max": float(hist.maximum),
+            "Total Counts": float(stats['total']), "Geometric Centre": float(stats['mean'].sum())}
+  for i, region in enumerate(COLON_REGIONS[:-1]):
+    label = i + 1
+    result["%s Voxels" % region] = int(stats['voxels'][label])
+    result["%s Volume cc" % region] = round(stats['voxels'][label] * cubicMMPerVoxel * CC_PER_CUBIC_MM, 3)
+    result["%s Counts" % region] = float(stats['counts'][label])
+  return result
+
+
+def analyseStudy(job):
+  """Process pool entry point: returns (study, rows, error)"""
+  study, rows, fixSpacing, maxBytes = job
+  try:
+    results = [analyseTimepoint(row, fixSpacing, maxBytes) for row in rows]
+    results.sort(key=lambda r: TIMEPOINTS.index(r["Timepoint"]))
+    return study, results, None
+  except Exception as e:
+    return study, None, "%s: %s" % (e.__class__.__name__, e)
+
+
+def checkpointPath(outputDir, study):
+  return os.path.join(outputDir, 'checkpoints', re.sub(r'[^\w.-]', '_', study) + '.json')
+
+
+def readCheckpoint(outputDir, study):
+  fileName = checkpointPath(outputDir, study)
+  if not os.path.exists(fileName):
+    return None
+  with open(fileName) as fp:
+    checkpoint = json.load(fp)
+  if checkpoint.get('study') != study:
+    return None
+  return checkpoint['rows']
+
+
+def writeCheckpoint(outputDir, study, rows):
+  """Write the checkpoint atomically so a killed run never leaves half a file"""
+  fileName = checkpointPath(outputDir, study)
+  tmpName = fileName + '.tmp'
+  with open(tmpName, 'w') as fp:
+    json.dump({'study': study, 'rows': rows}, fp)
+  replaceFile(tmpName, fileName)
+
+
+def runBatch(manifest, outputDir, workers=None, fixSpacing=False, log=None, maxBytes=None):
+  """Analyse every study in the manifest that has no checkpoint yet, on a
+  process pool of workers processes, or in this process if workers is 1.
+  Returns a dict with the numbers of studies done, skipped and failed and
+  the failure messages by study.
+  """
+  if log is None:
+    log = lambda message: sys.stdout.write(message + "\n")
+  studies = readManifest(manifest)
+  if not os.path.isdir(os.path.join(outputDir, 'checkpoints')):
+    os.makedirs(os.path.join(outputDir, 'checkpoints'))
+  pending = [(study, rows, fixSpacing, maxBytes) for study, rows in studies
+             if readCheckpoint(outputDir, study) is None]
+  summary = {'done': 0, 'skipped': len(studies) - len(pending), 'failed': {}}
+  pool = None
+  if len(pending) > 1 and workers != 1:
+    pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+  try:
+    results = pool.imap_unordered(analyseStudy, pending) if pool else (analyseStudy(job) for job in pending)
+    for study, rows, error in results:
+      if error:
+        summary['failed'][study] = error
+        log("%s failed: %s" % (study, error))
+      else:
+        writeCheckpoint(outputDir, study, rows)
+        summary['done'] += 1
+        log("%s done" % study)
+  finally:
+    if pool:
+      pool.close()
+      pool.join()
+  with open(os.path.join(outputDir, 'stats.csv'), 'w') as fp:
+    writer = csv.DictWriter(fp, statsColumns(), lineterminator='\n')
+    writer.writeheader()
+    for study, rows in studies:
+      for row in readCheckpoint(outputDir, study) or []:
+        writer.writerow(row)
+  return summary
+
+
+def main(argv=None):
+  import argparse
+  parser = argparse.ArgumentParser(description="Headless colonic transit batch analysis")
+  parser.add_argument('manifest', help="CSV with study, timepoint, spect, label and optional ct columns")
+  parser.add_argument('outputDir', help="directory for stats.csv and the checkpoints")
+  parser.add_argument('--workers', type=int, default=None, help="worker processes, default one per core")
+  parser.add_argument('--fix-spacing', action='store_true',
+                      help="copy the SPECT x spacing to z, as Fix Volumes does after a DICOM import")
+  parser.add_argument('--max-memory', type=int, default=None,
+                      help="working memory of the statistics per worker in MB, default a single pass")
+  args = parser.parse_args(argv)
+  maxBytes = args.max_memory * 1048576 if args.max_memory else None
+  summary = runBatch(args.manifest, args.outputDir, args.workers, args.fix_spacing, maxBytes=maxBytes)
+  print("%d done, %d skipped, %d failed" % (summary['done'], summary['skipped'], len(summary['failed'])))
+  return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,225 @@
+"""Benchmarks of the logic hot paths on synthetic phantoms.
+
+  python -m ColonicAnalysisLib.Benchmark [--sizes 64,128] [--regions 7] [--counts 1000]
+                                         [--baseline FILE] [--write-baseline] [--tolerance 1.5]
+
+Each case generates a SPECT, label and CT phantom of size**3 voxels, so
+nothing is downloaded. The steps are named after the ColonicAnalysisLogic
+methods they stand for and run the same NumPy code without a MRML scene.
+Wall time and peak traced memory are reported per case and step, and
+compared with the 'headless' section of the baseline JSON. The exit status
+is 1 if a step is slower or bigger than the baseline by more than the
+tolerance factor. ColonicAnalysisTest.test_Phantom times the real logic
+methods on the same phantoms; those timings depend on the Slicer build and
+are only reported, the 'headless' section is the one regression checked.
+"""
+import json
+import os
+import sys
+import time
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+import numpy as np
+
+from .LabelStatistics import COLON_REGIONS, labelStatistics, statsTable
+from .Memory import compactDtype
+from .Naming import TIMEPOINTS, classifyVolumeName
+from .StatsIO import statsAsCSV
+from .Threshold import VolumeHistogram, backgroundThreshold, buildThresholdIndex, thresholdVoxels
+
+__all__ = ['makePhantom', 'phantomVolumeNames', 'measure', 'caseName', 'runCases', 'headlessSteps',
+           'compareBaseline', 'readBaseline', 'writeBaseline', 'BASELINE_FILE']
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'Resources', 'Benchmark', 'baseline.json')
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def makePhantom(size, numRegions=len(COLON_REGIONS) - 1, countLevel=1000, seed=0, spacing=(4.0, 4.0, 4.0)):
+  """Synthetic study of size**3 voxels.
+  The colon is an annulus in the axial slices of the middle half of the
+  volume, cut into numRegions sectors labelled 1..numRegions. SPECT counts
+  are Poisson, with a mean of countLevel in the first region falling to a
+  tenth of it in the last over a background of countLevel / 50. The CT has
+  air outside the body, soft tissue inside and gas in the colon.
+  Returns a dict of int16 arrays in [k,j,i] order under 'CT', 'SP' and
+  'LA', and the xyz 'spacing'.
+  """
+  if not 1 <= numRegions < len(COLON_REGIONS):
+    raise ValueError("numRegions must be between 1 and %d" % (len(COLON_REGIONS) - 1))
+  random = np.random.RandomState(seed)
+  centre = (size - 1) / 2.0
+  j, i = np.ogrid[:size, :size]
+  radius = np.hypot(j - centre, i - centre) / size
+  sector = (np.arctan2(j - centre, i - centre) + np.pi) / (2 * np.pi) * numRegions
+  sliceLabels = np.where((radius > 0.25) & (radius < 0.35),
+                         np.minimum(sector.astype(np.int16), numRegions - 1) + 1, 0).astype(np.int16)
+  sliceBody = np.where(radius < 0.45, 40, -1000).astype(np.int16)
+  sliceCT = np.where(sliceLabels > 0, -800, sliceBody).astype(np.int16)
+  means = np.empty(numRegions + 1)
+  means[0] = countLevel / 50.0
+  means[1:] = np.linspace(countLevel, countLevel / 10.0, numRegions)
+  arrayl = np.zeros((size, size, size), dtype=np.int16)
+  arrayv = np.empty((size, size, size), dtype=np.int16)
+  arrayc = np.empty((size, size, size), dtype=np.int16)
+  colon = slice(size // 4, size - size // 4)
+  arrayl[colon] = sliceLabels
+  # a slice at a time keeps the float and int64 temporaries small at 512**3
+  for k in range(size):
+    arrayv[k] = np.minimum(random.poisson(means[arrayl[k]]), np.iinfo(np.int16).max)
+    arrayc[k] = sliceCT if colon.start <= k < colon.stop else sliceBody
+  return {'CT': arrayc, 'SP': arrayv, 'LA': arrayl, 'spacing': tuple(spacing)}
+
+
+def phantomVolumeNames(timePoint=TIMEPOINTS[0]):
+  """Volume names for a phantom study as the DICOM import and the module give them"""
+  return {'CT': "%s CTAC" % timePoint, 'SP': "%s Transaxials" % timePoint,
+          'TH': "%s Transaxials-threshold" % timePoint, 'LA': "%s Transaxials-label" % timePoint}
+
+
+def measure(function, *args):
+  """Call function(*args) and return (seconds, peak bytes allocated).
+  The peak is None where tracemalloc is not available."""
+  if tracemalloc:
+    tracemalloc.start()
+  try:
+    start = timer()
+    function(*args)
+    seconds = timer() - start
+    peakBytes = tracemalloc.get_traced_memory()[1] if tracemalloc else None
+  finally:
+    if tracemalloc:
+      tracemalloc.stop()
+  return seconds, peakBytes
+
+
+def caseName(size, numRegions, countLevel):
+  return "%d^3 regions=%d counts=%d" % (size, numRegions, countLevel)
+
+
+def runCases(cases, steps, prepare=dict, finish=None, log=None):
+  """Time steps on a phantom for every (size, numRegions, countLevel) case.
+  steps is a list of (name, function(state)) run in order; prepare(phantom)
+  returns the state they share and finish(state) releases it.
+  Returns {caseName: {stepName: {'seconds': s, 'peakBytes': b}}}.
+  """
+  if log is None:
+    log = lambda message: sys.stdout.write(message + "\n")
+  results = {}
+  for size, numRegions, countLevel in cases:
+    name = caseName(size, numRegions, countLevel)
+    state = prepare(makePhantom(size, numRegions, countLevel))
+    try:
+      timings = results[name] = {}
+      for stepName, step in steps:
+        seconds, peakBytes = measure(step, state)
+        timings[stepName] = {'seconds': seconds, 'peakBytes': peakBytes}
+        log("%-32s %-20s %9.4f s %s" % (name, stepName, seconds,
+            "%9.1f MB" % (peakBytes / 1048576.0) if peakBytes is not None else ""))
+    finally:
+      if finish:
+        finish(state)
+  return results
+
+
+def headlessSteps():
+  """The logic hot paths on the phantom arrays, without a MRML scene"""
+  names = []
+  for tp in TIMEPOINTS:
+    names += phantomVolumeNames(tp).values()
+
+  # the registry behind updateActiveVolumes needs a scene, this is the
+  # name matching it does for every volume
+  def classifyVolumeNames(state):
+    state['volumes'] = [classifyVolumeName(name) for name in names]
+
+  def calculateThreshold(state):
+    state['hist'] = VolumeHistogram(state['SP'])
+    state['index'] = buildThresholdIndex(state['SP'])
+    state['threshold'] = backgroundThreshold(state['hist'])
+    hist = state['hist']
+    state['TH'] = state['SP'].astype(compactDtype(min(hist.minimum, 0), hist.maximum, state['SP'].dtype))
+
+  def applyThreshold(state):
+    thresholdVoxels(state['SP'], state['TH'], state['threshold'], state['index'])
+
+  def computeMean(state):
+    stats = labelStatistics(state['SP'], state['LA'], len(COLON_REGIONS))
+    state['labelStats'] = statsTable(stats, state['spacing'])[0]
+
+  def statsAsCSVStep(state):
+    statsAsCSV(state['labelStats'])
+
+  return [('classifyVolumeNames', classifyVolumeNames), ('calculateThreshold', calculateThreshold),
+          ('applyThreshold', applyThreshold), ('computeMean', computeMean), ('statsAsCSV', statsAsCSVStep)]
+
+
+def compareBaseline(results, baseline, tolerance=1.5, minSeconds=0.01, minBytes=1048576):
+  """Messages for every step that took more than tolerance times its baseline
+  time or peak memory. Differences under minSeconds or minBytes are noise and
+  steps without a baseline are not compared."""
+  regressions = []
+  for name in sorted(results):
+    for stepName, timing in sorted(results[name].items()):
+      base = baseline.get(name, {}).get(stepName)
+      if not base:
+        continue
+      if timing['seconds'] > max(base['seconds'] * tolerance, base['seconds'] + minSeconds):
+        regressions.append("%s %s: %.4f s, baseline %.4f s" % (name, stepName, timing['seconds'], base['seconds']))
+      if timing['peakBytes'] is not None and base.get('peakBytes') is not None and \
+          timing['peakBytes'] > max(base['peakBytes'] * tolerance, base['peakBytes'] + minBytes):
+        regressions.append("%s %s: %d bytes, baseline %d bytes" % (name, stepName, timing['peakBytes'], base['peakBytes']))
+  return regressions
+
+
+def readBaseline(fileName=BASELINE_FILE, section='headless'):
+  if not os.path.exists(fileName):
+    return {}
+  with open(fileName) as fp:
+    return json.load(fp).get(section, {})
+
+
+def writeBaseline(results, fileName=BASELINE_FILE, section='headless'):
+  """Store results as the baseline section, keeping the other sections"""
+  baseline = {}
+  if os.path.exists(fileName):
+    with open(fileName) as fp:
+      baseline = json.load(fp)
+  baseline[section] = results
+  if not os.path.isdir(os.path.dirname(fileName)):
+    os.makedirs(os.path.dirname(fileName))
+  with open(fileName, 'w') as fp:
+    json.dump(baseline, fp, indent=1, sort_keys=True)
+    fp.write("\n")
+
+
+def main(argv=None):
+  import argparse
+  parser = argparse.ArgumentParser(description="Benchmark the colonic analysis hot paths on synthetic phantoms")
+  parser.add_argument('--sizes', default='64,128', help="comma separated phantom edge lengths, 64 to 512")
+  parser.add_argument('--regions', default=str(len(COLON_REGIONS) - 1), help="comma separated region counts")
+  parser.add_argument('--counts', default='1000', help="comma separated mean counts in the first region")
+  parser.add_argument('--baseline', default=BASELINE_FILE, help="baseline JSON, default %(default)s")
+  parser.add_argument('--write-baseline', action='store_true', help="store the results as the new baseline")
+  parser.add_argument('--tolerance', type=float, default=1.5, help="allowed slowdown factor, default %(default)s")
+  args = parser.parse_args(argv)
+  cases = [(int(size), int(regions), int(counts)) for size in args.sizes.split(',')
+           for regions in args.regions.split(',') for counts in args.counts.split(',')]
+  results = runCases(cases, headlessSteps())
+  if args.write_baseline:
+    writeBaseline(results, args.baseline)
+    print("Baseline written to %s" % args.baseline)
+    return 0
+  regressions = compareBaseline(results, readBaseline(args.baseline), args.tolerance)
+  for message in regressions:
+    print("Regression: %s" % message)
+  return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
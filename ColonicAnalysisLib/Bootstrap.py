@@ -0,0 +1,54 @@
+"""Poisson bootstrap of the label statistics.
+
+SPECT counts are Poisson distributed, and the counts of a region, being a
+sum of independent Poisson voxel counts, are Poisson distributed with
+their total as the mean. Resampling the per label counts therefore gives
+the same distribution as resampling every voxel, at the cost of numLabels
+draws per resample instead of one per voxel.
+"""
+import numpy as np
+
+from .Parallel import runParallel
+
+__all__ = ['bootstrapCounts', 'bootstrapStatistics']
+
+
+def bootstrapBlock(counts, numResamples, seed, block):
+  """numResamples Poisson resamples of counts from the generator of block"""
+  # the block index is part of the seed, so the draws do not depend on how
+  # the blocks are shared between the threads
+  random = np.random.RandomState([seed, block])
+  return random.poisson(counts, size=(numResamples, counts.size))
+
+
+def bootstrapCounts(counts, numResamples=2000, seed=0, blockSize=500, maxWorkers=3):
+  """(numResamples, numLabels) array of Poisson resampled label counts,
+  drawn in blocks of blockSize resamples on the thread pool. The same seed
+  gives the same resamples whatever maxWorkers is."""
+  counts = np.maximum(np.asarray(counts, dtype=np.float64), 0)
+  blocks = [(block, min(blockSize, numResamples - start))
+            for block, start in enumerate(range(0, numResamples, blockSize))]
+  resamples = runParallel(lambda job: bootstrapBlock(counts, job[1], seed, job[0]), blocks, maxWorkers)
+  if not resamples:
+    return np.zeros((0, counts.size), dtype=np.int64)
+  return np.concatenate(resamples)
+
+
+def bootstrapStatistics(counts, numResamples=2000, confidence=0.95, seed=0, blockSize=500, maxWorkers=3):
+  """Confidence intervals of the label statistics of labelStatistics
+  'counts', label 0 not counting as in labelStatistics.
+  Returns a dict of (low, high) intervals: 'counts' and 'fraction' (of the
+  total counts) with one row per label, and 'geometricCentre'.
+  """
+  counts = np.array(counts, dtype=np.float64)
+  counts[0] = 0
+  resampled = bootstrapCounts(counts, numResamples, seed, blockSize, maxWorkers)
+  total = resampled.sum(axis=1).astype(np.float64)
+  nonZero = np.maximum(total, 1).reshape(-1, 1)
+  fraction = resampled / nonZero
+  centre = (fraction * np.arange(counts.size)).sum(axis=1)
+  tails = [50 * (1 - confidence), 50 * (1 + confidence)]
+  return {'counts': np.percentile(resampled, tails, axis=0).T,
+          'fraction': np.percentile(fraction, tails, axis=0).T,
+          'geometricCentre': np.percentile(centre, tails),
+          'numResamples': numResamples, 'confidence': confidence, 'seed': seed}
@@ -0,0 +1,272 @@
+"""SPECT/CTAC series loader for colonic transit studies.
+
+Reads the DICOM files of a study directory straight into arrays with the
+right spacing, origin and directions, so nothing needs fixing after the
+load, and classifies every series by timepoint and role (see Naming).
+Headers are parsed on a thread pool and cached per file; pixel data is
+read into one preallocated array per series. Needs pydicom, which is
+imported on first use so the rest of the package works without it.
+"""
+import os
+
+import numpy as np
+
+from .Memory import compactDtype
+from .Naming import TIMEPOINTS, classifyVolumeName
+from .Parallel import runParallel
+
+__all__ = ['DicomHeaderCache', 'readDicomHeader', 'scanDicomDirectory', 'classifySeries',
+           'seriesGeometry', 'readSeriesPixels', 'loadDicomStudy', 'writeSyntheticSeries']
+
+
+def importPydicom():
+  """pydicom, or the dicom package of the releases Slicer bundled before it was renamed"""
+  try:
+    import pydicom
+  except ImportError:
+    try:
+      import dicom as pydicom
+    except ImportError:
+      raise ImportError("Loading DICOM studies needs pydicom")
+  return pydicom
+
+
+def dcmread(fileName, **kwargs):
+  pydicom = importPydicom()
+  read = getattr(pydicom, 'dcmread', None) or pydicom.read_file
+  return read(fileName, **kwargs)
+
+
+def floats(value, default=None):
+  if value is None or value == '':
+    return default
+  return [float(v) for v in value]
+
+
+def readDicomHeader(fileName):
+  """The header fields the loader needs as a plain dict, or None if fileName
+  is not a DICOM image"""
+  try:
+    ds = dcmread(fileName, stop_before_pixels=True)
+  except Exception:
+    return None
+  if 'Rows' not in ds or 'SeriesInstanceUID' not in ds:
+    return None
+  header = {
+    'fileName': fileName,
+    'series': str(ds.SeriesInstanceUID),
+    'description': str(ds.get('SeriesDescription', '')),
+    'modality': str(ds.get('Modality', '')),
+    'instance': int(ds.get('InstanceNumber') or 0),
+    'rows': int(ds.Rows),
+    'columns': int(ds.Columns),
+    'frames': int(ds.get('NumberOfFrames') or 1),
+    'bitsAllocated': int(ds.get('BitsAllocated') or 16),
+    'bitsStored': int(ds.get('BitsStored') or ds.get('BitsAllocated') or 16),
+    'signed': int(ds.get('PixelRepresentation') or 0) == 1,
+    'pixelSpacing': floats(ds.get('PixelSpacing'), [1.0, 1.0]),
+    'sliceThickness': float(ds.get('SliceThickness') or 0) or None,
+    'spacingBetweenSlices': float(ds.get('SpacingBetweenSlices') or 0) or None,
+    'position': floats(ds.get('ImagePositionPatient')),
+    'orientation': floats(ds.get('ImageOrientationPatient')),
+    'slope': float(ds.get('RescaleSlope') or 1.0),
+    'intercept': float(ds.get('RescaleIntercept') or 0.0)}
+  # NM reconstructions keep their geometry in the detector information
+  detectors = ds.get('DetectorInformationSequence')
+  if detectors and len(detectors):
+    if header['position'] is None:
+      header['position'] = floats(detectors[0].get('ImagePositionPatient'))
+    if header['orientation'] is None:
+      header['orientation'] = floats(detectors[0].get('ImageOrientationPatient'))
+  return header
+
+
+class DicomHeaderCache(object):
+  """Parsed headers by file name, reused as long as the size and modification
+  time of the file are unchanged, so rescanning a study only parses new files"""
+  def __init__(self):
+    self.headers = {}
+
+  def header(self, fileName):
+    stat = os.stat(fileName)
+    key = (stat.st_mtime, stat.st_size)
+    cached = self.headers.get(fileName)
+    if cached and cached[0] == key:
+      return cached[1]
+    header = readDicomHeader(fileName)
+    self.headers[fileName] = (key, header)
+    return header
+
+
+def scanDicomDirectory(directory, cache=None, maxWorkers=4):
+  """Parse the headers below directory on a thread pool.
+  Returns {series UID: [headers]} for every image series found."""
+  if cache is None:
+    cache = DicomHeaderCache()
+  fileNames = []
+  for root, dirs, files in os.walk(directory):
+    dirs.sort()
+    fileNames += [os.path.join(root, f) for f in sorted(files)]
+  series = {}
+  for header in runParallel(cache.header, fileNames, maxWorkers):
+    if header:
+      series.setdefault(header['series'], []).append(header)
+  return series
+
+
+def classifySeries(header, timepoints=TIMEPOINTS):
+  """(timepoint, role) of a series judged by its description, as the DICOM
+  import would name the volume, falling back to the modality for the role.
+  None if the series belongs to no timepoint."""
+  matches = classifyVolumeName(header['description'], timepoints)
+  if matches:
+    return matches[0]
+  role = {'CT': 'CT', 'NM': 'SP', 'PT': 'SP'}.get(header['modality'])
+  for tp in timepoints:
+    if role and tp in header['description']:
+      return tp, role
+  return None
+
+
+def seriesGeometry(headers):
+  """Sort the headers of a series into slice order and work out its geometry.
+  Returns (headers, spacing, origin, axes): the (x, y, z) spacing, the RAS
+  origin, or None if the series has no position, and the RAS unit vectors
+  of the i, j and k axes.
+  Single frame series are ordered along the slice normal and take the slice
+  spacing from the positions. Multi-frame NM transaxials run from head to
+  feet, against the normal, with SpacingBetweenSlices or SliceThickness
+  between frames or else the in-plane spacing, as the generic import got
+  wrong and fixVolumes used to patch.
+  """
+  first = headers[0]
+  orientation = first['orientation'] or [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+  row = np.array(orientation[:3])
+  column = np.array(orientation[3:])
+  normal = np.cross(row, column)
+  # PixelSpacing is the distance between rows, then between columns
+  ySpacing, xSpacing = first['pixelSpacing'][0], first['pixelSpacing'][1]
+  if first['frames'] > 1 or len(headers) == 1:
+    headers = [first]
+    sliceVector = -normal
+    sliceSpacing = first['spacingBetweenSlices'] or first['sliceThickness'] or xSpacing
+  else:
+    if all(h['position'] for h in headers):
+      headers = sorted(headers, key=lambda h: np.dot(h['position'], normal))
+      distances = np.diff([np.dot(h['position'], normal) for h in headers])
+      sliceSpacing = float(np.median(distances)) or first['sliceThickness'] or xSpacing
+    else:
+      headers = sorted(headers, key=lambda h: h['instance'])
+      sliceSpacing = first['spacingBetweenSlices'] or first['sliceThickness'] or xSpacing
+    sliceVector = normal
+  lpsToRAS = np.array([-1.0, -1.0, 1.0])
+  axes = [tuple(float(v) for v in vector * lpsToRAS) for vector in (row, column, sliceVector)]
+  origin = None
+  if headers[0]['position']:
+    origin = tuple(float(v) for v in np.array(headers[0]['position']) * lpsToRAS)
+  return headers, (xSpacing, ySpacing, sliceSpacing), origin, axes
+
+
+def pixelDtype(headers):
+  """Smallest type holding the rescaled pixel values of every slice of a
+  series, float32 if any slice is rescaled to non integer values"""
+  lows, highs = [], []
+  for header in headers:
+    if header['slope'] != 1.0 or header['intercept'] != int(header['intercept']):
+      return np.dtype(np.float32)
+    if header['signed']:
+      low, high = -2 ** (header['bitsStored'] - 1), 2 ** (header['bitsStored'] - 1) - 1
+    else:
+      low, high = 0, 2 ** header['bitsStored'] - 1
+    lows.append(low + int(header['intercept']))
+    highs.append(high + int(header['intercept']))
+  return compactDtype(min(lows), max(highs), np.int32)
+
+
+def readSeriesPixels(headers, maxWorkers=4):
+  """Read the pixel data of sorted series headers into one [k, j, i] array"""
+  first = headers[0]
+  numSlices = first['frames'] if len(headers) == 1 else len(headers)
+  array = np.empty((numSlices, first['rows'], first['columns']), dtype=pixelDtype(headers))
+
+  def readSlice(job):
+    k, header = job
+    pixels = dcmread(header['fileName']).pixel_array
+    if header['slope'] != 1.0 or header['intercept']:
+      pixels = pixels * header['slope'] + header['intercept']
+    if pixels.ndim == 2:
+      pixels = pixels[np.newaxis]
+    array[k:k + pixels.shape[0]] = pixels
+
+  runParallel(readSlice, list(enumerate(headers)), maxWorkers)
+  return array
+
+
+def loadDicomStudy(directory, timepoints=TIMEPOINTS, cache=None, maxWorkers=4):
+  """Load every SPECT and CT series of a study directory that belongs to one
+  of timepoints. Returns a list of dicts with the 'timepoint', 'role',
+  volume 'name', 'array' ([k, j, i]), (x, y, z) 'spacing', RAS 'origin'
+  (None to centre the volume) and RAS 'axes' of each series, in timepoint
+  and role order.
+  """
+  volumes = []
+  for uid, headers in scanDicomDirectory(directory, cache, maxWorkers).items():
+    match = classifySeries(headers[0], timepoints)
+    if not match:
+      continue
+    headers, spacing, origin, axes = seriesGeometry(headers)
+    description = headers[0]['description']
+    name = description if match[0] in description else "%s %s" % (match[0], description)
+    volumes.append({'timepoint': match[0], 'role': match[1], 'name': name,
+                    'array': readSeriesPixels(headers, maxWorkers),
+                    'spacing': spacing, 'origin': origin, 'axes': axes})
+  roles = ('CT', 'SP', 'TH', 'LA')
+  volumes.sort(key=lambda v: (timepoints.index(v['timepoint']), roles.index(v['role'])))
+  return volumes
+
+
+def writeSyntheticSeries(directory, array, spacing, description, modality='NM', position=(0.0, 0.0, 0.0)):
+  """Write an int16 [k, j, i] array as a DICOM series for tests: a multi-frame
+  file running from head to feet for NM, one file per slice for CT.
+  position is the LPS position of the first slice."""
+  pydicom = importPydicom()
+  Dataset, FileDataset = pydicom.dataset.Dataset, pydicom.dataset.FileDataset
+  uid = getattr(pydicom, 'uid', None) or pydicom.UID
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  seriesUID = uid.generate_uid()
+  multiFrame = modality != 'CT'
+  slices = [array] if multiFrame else [array[k:k + 1] for k in range(array.shape[0])]
+  for k, pixels in enumerate(slices):
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.20' if multiFrame else '1.2.840.10008.5.1.4.1.1.2'
+    meta.MediaStorageSOPInstanceUID = uid.generate_uid()
+    meta.TransferSyntaxUID = uid.ExplicitVRLittleEndian
+    fileName = os.path.join(directory, "%s-%04d.dcm" % (modality, k))
+    ds = FileDataset(fileName, {}, file_meta=meta, preamble=b"\0" * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.SeriesInstanceUID = seriesUID
+    ds.SeriesDescription = description
+    ds.Modality = modality
+    ds.InstanceNumber = k + 1
+    ds.Rows, ds.Columns = array.shape[1], array.shape[2]
+    ds.PixelSpacing = [spacing[1], spacing[0]]
+    ds.SliceThickness = spacing[2]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    # NM frames run towards the feet, CT slices towards the head
+    sliceZ = position[2] - k * spacing[2] if multiFrame else position[2] + k * spacing[2]
+    ds.ImagePositionPatient = [position[0], position[1], sliceZ]
+    if multiFrame:
+      ds.NumberOfFrames = array.shape[0]
+      ds.SpacingBetweenSlices = spacing[2]
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.PixelData = np.ascontiguousarray(pixels, dtype='<i2').tobytes()
+    ds.save_as(fileName)
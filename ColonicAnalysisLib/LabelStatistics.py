@@ -0,0 +1,239 @@
+import numpy as np
+
+__all__ = ['STATS_KEYS', 'COLON_REGIONS', 'CC_PER_CUBIC_MM',
+           'labelStatistics', 'stackStatistics', 'thresholdSweep', 'sweepThresholds', 'LabelStatsTracker',
+           'geometricCentre', 'voxelVolume', 'statsTable', 'statsRecords']
+
+STATS_KEYS = ("Label", "Voxels", "Volume cc", "Total Counts", "SPECT Mean")
+COLON_REGIONS = ("ascending_1", "ascending_2", "transverse_1",
+  "transverse_2", "transverse_3", "transverse_4", "neorectum", "stool")
+CC_PER_CUBIC_MM = 0.001
+
+
+# working memory per voxel of a labelStatistics pass: the intp labels and
+# float64 weights bincount converts to, plus the positive SPECT mask
+BYTES_PER_VOXEL = 24
+
+
+def labelSums(arrayv, arrayl, numLabels):
+  """Raw per label voxel and count sums of labels 0..numLabels-1 in a single
+  weighted bincount over the flattened arrays. Negative labels count as 0."""
+  labels = arrayl.ravel()
+  values = arrayv.ravel()
+  if labels.dtype.kind == 'i' and labels.min() < 0:
+    labels = np.where(labels < 0, 0, labels)
+  voxels = np.bincount(labels, weights=(values > 0), minlength=numLabels)[:numLabels]
+  counts = np.bincount(labels, weights=values, minlength=numLabels)[:numLabels]
+  if values.dtype.kind in 'iub':
+    # exact per block, so blocks add up to the whole volume sum
+    counts = np.rint(counts).astype(np.int64)
+  return voxels.astype(np.int64), counts
+
+
+def slabSize(shape, maxBytes, bytesPerVoxel=BYTES_PER_VOXEL):
+  """Number of k slices processed at once within a working memory of maxBytes"""
+  sliceVoxels = int(np.prod(shape[1:])) or 1
+  return max(1, int(maxBytes // (bytesPerVoxel * sliceVoxels)))
+
+
+def labelStatistics(arrayv, arrayl, numLabels, maxBytes=None):
+  """Voxel count, total counts and geometric centre contribution for labels
+  0..numLabels-1. Voxels only counts voxels with a positive SPECT value.
+  With maxBytes the volume is processed in slabs of k slices whose working
+  memory stays under maxBytes; the sums are accumulated in place and the
+  result equals the single pass one.
+  """
+  if maxBytes is None:
+    voxels, counts = labelSums(arrayv, arrayl, numLabels)
+  else:
+    step = slabSize(arrayl.shape, maxBytes)
+    voxels = np.zeros(numLabels, dtype=np.int64)
+    counts = np.zeros(numLabels, dtype=np.int64 if arrayv.dtype.kind in 'iub' else np.float64)
+    for k in range(0, arrayl.shape[0], step):
+      slabVoxels, slabCounts = labelSums(arrayv[k:k + step], arrayl[k:k + step], numLabels)
+      voxels += slabVoxels
+      counts += slabCounts
+  counts[0] = 0
+  total = counts.sum()
+  if total:
+    mean = counts * np.arange(numLabels) / float(total)
+  else:
+    mean = np.zeros(numLabels)
+  return {'voxels': voxels, 'counts': counts, 'total': total, 'mean': mean}
+
+
+def stackStatistics(statsList):
+  """Label statistics of several timepoints from their labelStatistics output.
+  Returns (timepoints, numLabels) arrays 'voxels' and 'counts' and per
+  timepoint arrays 'total' and 'geometricCentre'.
+  """
+  counts = np.array([stats['counts'] for stats in statsList])
+  total = np.array([stats['total'] for stats in statsList])
+  weighted = (counts * np.arange(counts.shape[1])).sum(axis=1)
+  centre = np.where(total > 0, weighted / np.maximum(total, 1).astype(np.float64), 0.0)
+  return {'voxels': np.array([stats['voxels'] for stats in statsList]), 'counts': counts,
+          'total': total, 'geometricCentre': centre}
+
+
+def thresholdSweep(arrayv, arrayl, numLabels, thresholds):
+  """Label statistics of arrayv thresholded at each of thresholds, as the
+  threshold volume keeps the voxels >= the threshold, without thresholding
+  anything. The labelled voxels are sorted by label and value once; for
+  every threshold the counts of a label are then a difference of its
+  cumulative sums and the voxels a difference of positions in its run.
+  Returns stackStatistics form with one row per threshold. Labels
+  outside 1..numLabels-1 are left out, as label 0 is of the total counts.
+  """
+  thresholds = np.asarray(thresholds)
+  labels = arrayl.ravel()
+  values = arrayv.ravel()
+  inside = (labels > 0) & (labels < numLabels)
+  labels = labels[inside]
+  values = values[inside]
+  order = np.lexsort((values, labels))
+  labels = labels[order]
+  values = values[order]
+  integer = values.dtype.kind in 'iub'
+  cumulative = np.zeros(values.size + 1, dtype=np.int64 if integer else np.float64)
+  np.cumsum(values, out=cumulative[1:])
+  starts = np.searchsorted(labels, np.arange(numLabels + 1))
+  shape = (thresholds.size, numLabels)
+  voxels = np.zeros(shape, dtype=np.int64)
+  counts = np.zeros(shape, dtype=cumulative.dtype)
+  for label in range(1, numLabels):
+    start, stop = starts[label], starts[label + 1]
+    run = values[start:stop]
+    kept = start + np.searchsorted(run, thresholds, side='left')
+    positive = start + np.searchsorted(run, 0, side='right')
+    counts[:, label] = cumulative[stop] - cumulative[kept]
+    voxels[:, label] = stop - np.maximum(kept, positive)
+  total = counts.sum(axis=1)
+  weighted = (counts * np.arange(numLabels)).sum(axis=1)
+  centre = np.where(total > 0, weighted / np.maximum(total, 1).astype(np.float64), 0.0)
+  return {'thresholds': thresholds, 'voxels': voxels, 'counts': counts, 'total': total,
+          'geometricCentre': centre}
+
+
+def sweepThresholds(threshold, maximum, num=256):
+  """Up to num integer thresholds from 0 to three times threshold, or to
+  maximum if that is lower or threshold is 0"""
+  stop = min(3 * threshold, maximum) if threshold > 0 else maximum
+  return np.unique(np.linspace(0, stop, num).astype(np.int64))
+
+
+class LabelStatsTracker(object):
+  """Per label voxel and count totals of a label map that is being painted.
+  update() recounts only the block that changed since the previous call: the
+  old contents of the block are subtracted and the new ones added, so the
+  cost follows the size of the brush stroke rather than of the volume.
+  """
+  def __init__(self, arrayv, arrayl, numLabels):
+    self.arrayv = arrayv
+    self.numLabels = numLabels
+    self.shadow = arrayl.copy()
+    self.changed = np.empty(arrayl.shape, dtype=bool)
+    self.voxels, self.counts = self.blockSums(arrayv, arrayl)
+
+  def blockSums(self, arrayv, arrayl):
+    """Raw per label voxel and count sums of a block, labels outside
+    0..numLabels-1 being treated as in labelStatistics"""
+    labels = np.clip(arrayl.ravel(), 0, self.numLabels)
+    values = arrayv.ravel()
+    voxels = np.bincount(labels, weights=(values > 0), minlength=self.numLabels + 1)
+    counts = np.bincount(labels, weights=values, minlength=self.numLabels + 1)
+    return voxels[:self.numLabels], counts[:self.numLabels]
+
+  def dirtyExtent(self, arrayl):
+    """VTK style (i0, i1, j0, j1, k0, k1) extent of the voxels that differ
+    from the previous label map, or None if nothing changed"""
+    np.not_equal(self.shadow, arrayl, out=self.changed)
+    bounds = []
+    for axis in (2, 1, 0):
+      others = tuple(a for a in (0, 1, 2) if a != axis)
+      hits = np.flatnonzero(self.changed.any(axis=others))
+      if not hits.size:
+        return None
+      bounds += [hits[0], hits[-1]]
+    return tuple(int(b) for b in bounds)
+
+  def update(self, arrayl, extent=None):
+    """Bring the totals up to date with arrayl. extent is the VTK style extent
+    that was painted, if known; otherwise it is found by comparing against the
+    previous label map. Returns False if nothing changed.
+    """
+    if extent is None:
+      extent = self.dirtyExtent(arrayl)
+      if extent is None:
+        return False
+    i0, i1, j0, j1, k0, k1 = extent
+    block = (slice(k0, k1 + 1), slice(j0, j1 + 1), slice(i0, i1 + 1))
+    oldVoxels, oldCounts = self.blockSums(self.arrayv[block], self.shadow[block])
+    newVoxels, newCounts = self.blockSums(self.arrayv[block], arrayl[block])
+    self.voxels += newVoxels - oldVoxels
+    self.counts += newCounts - oldCounts
+    self.shadow[block] = arrayl[block]
+    return True
+
+  def stats(self):
+    """Current totals in the form returned by labelStatistics"""
+    voxels = np.rint(self.voxels).astype(np.int64)
+    counts = self.counts.copy()
+    if self.arrayv.dtype.kind in 'iub':
+      counts = np.rint(counts).astype(np.int64)
+    counts[0] = 0
+    total = counts.sum()
+    if total:
+      mean = counts * np.arange(self.numLabels) / float(total)
+    else:
+      mean = np.zeros(self.numLabels)
+    return {'voxels': voxels, 'counts': counts, 'total': total, 'mean': mean}
+
+
+def geometricCentre(counts):
+  """Count weighted mean label index, label 0 being background"""
+  counts = np.asarray(counts)
+  total = counts[1:].sum()
+  if not total:
+    return 0.0
+  return float((counts[1:] * np.arange(1, counts.size)).sum()) / float(total)
+
+
+def voxelVolume(spacing):
+  """Volume of one voxel in cubic mm"""
+  return float(np.prod(spacing))
+
+
+def statsTable(stats, spacing):
+  """Convert labelStatistics output to the labelStats dictionary keyed by
+  (label, key) that the widget table and CSV export read.
+  Returns (labelStats, totalCounts, computedMean).
+  """
+  numLabels = stats['counts'].size
+  cubicMMPerVoxel = voxelVolume(spacing)
+  labelStats = {}
+  labelStats['Labels'] = []
+  for i in range(1, numLabels):
+    labelStats['Labels'].append(i)
+    labelStats[i, "Label"] = i
+    labelStats[i, "Voxels"] = stats['voxels'][i]
+    labelStats[i, "Total Counts"] = stats['counts'][i]
+    labelStats[i, "Volume cc"] = "%2.3f" % (stats['voxels'][i] * cubicMMPerVoxel * CC_PER_CUBIC_MM)
+  for i in range(numLabels):
+    labelStats[i, "SPECT Mean"] = "%2.3f" % stats['mean'][i]
+  return labelStats, stats['total'], stats['mean'].sum()
+
+
+def statsRecords(stats, spacing):
+  """labelStatistics output as a record array with one row per label from 1,
+  fields label, voxels, volume (cc), counts and mean (the label's share of
+  the geometric centre), in STATS_KEYS order"""
+  numLabels = stats['counts'].size
+  records = np.zeros(numLabels - 1, dtype=[
+    ('label', np.int32), ('voxels', np.int64), ('volume', np.float64),
+    ('counts', stats['counts'].dtype), ('mean', np.float64)])
+  records['label'] = np.arange(1, numLabels)
+  records['voxels'] = stats['voxels'][1:]
+  records['volume'] = stats['voxels'][1:] * voxelVolume(spacing) * CC_PER_CUBIC_MM
+  records['counts'] = stats['counts'][1:]
+  records['mean'] = stats['mean'][1:]
+  return records
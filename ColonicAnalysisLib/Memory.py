@@ -0,0 +1,57 @@
+import numpy as np
+
+__all__ = ['LABEL_DTYPE', 'VTK_SCALAR_TYPES', 'compactDtype', 'formatBytes', 'formatMemoryReport']
+
+# ColonColors.txt defines far fewer than 256 labels
+LABEL_DTYPE = np.dtype(np.uint8)
+
+# numpy dtype -> VTK scalar type constant, as in vtkType.h
+VTK_SCALAR_TYPES = {
+  np.dtype(np.int8): 15, np.dtype(np.uint8): 3,
+  np.dtype(np.int16): 4, np.dtype(np.uint16): 5,
+  np.dtype(np.int32): 6, np.dtype(np.uint32): 7,
+  np.dtype(np.float32): 10, np.dtype(np.float64): 11}
+
+INTEGER_TYPES = (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32)
+
+
+def compactDtype(minimum, maximum, dtype=np.int16):
+  """Smallest integer type holding minimum..maximum, never larger than
+  dtype. Non integer dtypes are returned unchanged, their values could not
+  be converted exactly."""
+  dtype = np.dtype(dtype)
+  if dtype.kind not in 'iu':
+    return dtype
+  for candidate in INTEGER_TYPES:
+    info = np.iinfo(candidate)
+    if info.min <= minimum and maximum <= info.max and np.dtype(candidate).itemsize <= dtype.itemsize:
+      return np.dtype(candidate)
+  return dtype
+
+
+def formatBytes(nbytes):
+  for unit in ('bytes', 'kB', 'MB'):
+    if nbytes < 1024:
+      return "%d %s" % (nbytes, unit) if unit == 'bytes' else "%.1f %s" % (nbytes, unit)
+    nbytes /= 1024.0
+  return "%.2f GB" % nbytes
+
+
+def formatMemoryReport(rows):
+  """Text table of (group, item, description, bytes) rows with a subtotal
+  per group and the total"""
+  lines = []
+  groups = []
+  totals = {}
+  for group, item, description, nbytes in rows:
+    if group not in totals:
+      groups.append(group)
+      totals[group] = 0
+    totals[group] += nbytes
+  for group in groups:
+    lines.append("%s: %s" % (group, formatBytes(totals[group])))
+    for rowGroup, item, description, nbytes in rows:
+      if rowGroup == group:
+        lines.append("  %-10s %-32s %10s" % (item, description, formatBytes(nbytes)))
+  lines.append("Total: %s" % formatBytes(sum(totals.values())))
+  return "\n".join(lines)
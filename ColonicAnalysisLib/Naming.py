@@ -0,0 +1,26 @@
+__all__ = ['TIMEPOINTS', 'ROLES', 'volumeRoles', 'classifyVolumeName']
+
+TIMEPOINTS = ("6HRS", "24HRS", "32HRS")
+# CT: CTAC volume, SP: SPECT transaxials, TH: thresholded SPECT, LA: label map
+ROLES = ('CT', 'SP', 'TH', 'LA')
+
+
+def volumeRoles(name):
+  """Roles a volume plays, judged by the names the DICOM import and the
+  module give them"""
+  roles = []
+  if name.find("CTAC") != -1:
+    roles.append('CT')
+  if name.endswith("Transaxials"):
+    roles.append('SP')
+  if name.endswith("Transaxials-threshold"):
+    roles.append('TH')
+  if name.endswith("label"):
+    roles.append('LA')
+  return roles
+
+
+def classifyVolumeName(name, timepoints=TIMEPOINTS):
+  """List of the (timepoint, role) pairs a volume name matches"""
+  roles = volumeRoles(name)
+  return [(tp, role) for tp in timepoints if tp in name for role in roles]
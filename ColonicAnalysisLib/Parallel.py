@@ -0,0 +1,20 @@
+from multiprocessing.pool import ThreadPool
+
+__all__ = ['runParallel']
+
+
+def runParallel(function, items, maxWorkers=3):
+  """Map function over items on a thread pool and return the results in order.
+  NumPy releases the GIL so the items are processed concurrently.
+  Only pure NumPy work belongs here, MRML nodes must be updated by the
+  caller on the main thread.
+  """
+  items = list(items)
+  if len(items) < 2 or maxWorkers < 2:
+    return [function(item) for item in items]
+  pool = ThreadPool(min(maxWorkers, len(items)))
+  try:
+    return pool.map(function, items)
+  finally:
+    pool.close()
+    pool.join()
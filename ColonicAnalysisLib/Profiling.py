@@ -0,0 +1,126 @@
+import json
+import sys
+import time
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+__all__ = ['Profiler', 'profileMethods', 'unprofileMethods']
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def maxRSSBytes():
+  """Peak resident set size of the process, ru_maxrss is in kB except on macOS"""
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class Profiler(object):
+  """Call counts, inclusive wall time, memory and extra counters per method.
+
+  The memory of a call is the peak of the memory traced by tracemalloc
+  above its level when the call started, which covers the NumPy arrays it
+  allocates. Where tracemalloc cannot reset its peak (Python before 3.9,
+  Python 2 in Slicer) the growth of the process peak resident size is used
+  instead, which only shows calls that raise the high-water mark.
+  counters maps a name to a function returning a running count, such as
+  the number of volume nodes added to the scene; each call records how far
+  every counter moved while it ran.
+  """
+  def __init__(self, counters=None):
+    self.counters = counters or {}
+    self.records = {}
+    # peak memory seen by each active call, innermost last
+    self.stack = []
+    self.traced = tracemalloc is not None and hasattr(tracemalloc, 'reset_peak')
+
+  def reset(self):
+    self.records = {}
+
+  def start(self):
+    if self.traced and not tracemalloc.is_tracing():
+      tracemalloc.start()
+
+  def stop(self):
+    if self.traced and tracemalloc.is_tracing():
+      tracemalloc.stop()
+
+  def memory(self):
+    if self.traced and tracemalloc.is_tracing():
+      return tracemalloc.get_traced_memory()
+    if resource:
+      rss = maxRSSBytes()
+      return rss, rss
+    return 0, 0
+
+  def call(self, name, function, *args, **kwargs):
+    """Run function(*args, **kwargs) and add the call to the record of name"""
+    current, peak = self.memory()
+    if self.stack:
+      self.stack[-1] = max(self.stack[-1], peak)
+    if self.traced and tracemalloc.is_tracing():
+      tracemalloc.reset_peak()
+    self.stack.append(0)
+    counts = dict((key, count()) for key, count in self.counters.items())
+    start = timer()
+    try:
+      return function(*args, **kwargs)
+    finally:
+      seconds = timer() - start
+      peak = max(self.stack.pop(), self.memory()[1])
+      if self.stack:
+        self.stack[-1] = max(self.stack[-1], peak)
+      record = self.records.get(name)
+      if record is None:
+        record = self.records[name] = dict(calls=0, seconds=0.0, peakBytes=0, **dict((key, 0) for key in self.counters))
+      record['calls'] += 1
+      record['seconds'] += seconds
+      record['peakBytes'] = max(record['peakBytes'], peak - current)
+      for key, count in self.counters.items():
+        record[key] += count() - counts[key]
+
+  def report(self):
+    """(name, record) pairs, the slowest first"""
+    return sorted(self.records.items(), key=lambda item: -item[1]['seconds'])
+
+  def asJSON(self):
+    return json.dumps(self.records, indent=1, sort_keys=True)
+
+  def saveJSON(self, fileName):
+    with open(fileName, 'w') as fp:
+      fp.write(self.asJSON() + "\n")
+
+
+def profileMethods(obj, profiler, exclude=()):
+  """Route every public method of obj's class through profiler.call by
+  shadowing it with an instance attribute. Returns the wrapped names."""
+  names = []
+  for name in dir(obj.__class__):
+    method = getattr(obj, name)
+    if name.startswith('_') or name in exclude or not callable(method):
+      continue
+    setattr(obj, name, wrapMethod(profiler, name, method))
+    names.append(name)
+  return names
+
+
+def wrapMethod(profiler, name, method):
+  def wrapper(*args, **kwargs):
+    return profiler.call(name, method, *args, **kwargs)
+  wrapper.__name__ = name
+  wrapper.__doc__ = method.__doc__
+  return wrapper
+
+
+def unprofileMethods(obj, names):
+  for name in names:
+    if name in obj.__dict__:
+      delattr(obj, name)
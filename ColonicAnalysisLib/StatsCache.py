@@ -0,0 +1,149 @@
+"""Content addressed cache of label statistics.
+
+The statistics of a timepoint only depend on its SPECT and label voxels,
+the voxel spacing and the number of labels, so they are stored under a
+hash of exactly those. A study that has not changed is found again after
+a view switch, a scene reload or a restart of Slicer, whatever its node
+IDs, and any edit of the voxels gives a new key, so entries never need
+invalidating, only evicting.
+"""
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from .VolumeIO import replaceFile
+
+__all__ = ['statsKey', 'StatsCache']
+
+STATS_FIELDS = ('voxels', 'counts', 'total', 'mean')
+
+# hash the voxel buffers in pieces, a full copy of a volume is never made
+HASH_BLOCK_BYTES = 1 << 24
+
+
+def newHash():
+  if hasattr(hashlib, 'blake2b'):
+    return hashlib.blake2b(digest_size=20)
+  return hashlib.sha1()
+
+
+def updateHash(digest, array):
+  digest.update(("%s %s;" % (array.dtype.str, array.shape)).encode('ascii'))
+  flat = array.reshape(-1) if array.flags.c_contiguous else np.ascontiguousarray(array).reshape(-1)
+  step = max(1, HASH_BLOCK_BYTES // max(1, flat.itemsize))
+  for start in range(0, flat.size, step):
+    digest.update(flat[start:start + step])
+
+
+def statsKey(arrayv, arrayl, spacing, numLabels):
+  """Hex digest of the SPECT and label voxels, spacing and number of labels"""
+  digest = newHash()
+  updateHash(digest, arrayv)
+  updateHash(digest, arrayl)
+  digest.update(("%r %d" % (tuple(float(s) for s in spacing), numLabels)).encode('ascii'))
+  return digest.hexdigest()
+
+
+class StatsCache(object):
+  """labelStatistics results by statsKey, in memory and optionally on disk.
+
+  The memory cache keeps the maxEntries most recently used results. On disk
+  every result is one small .npz file in directory; when the files add up
+  to more than maxDiskBytes the least recently used ones are removed. A
+  disk hit is copied into memory, and its modification time refreshed so
+  it counts as recently used.
+  """
+  def __init__(self, directory=None, maxEntries=64, maxDiskBytes=16 * 1048576):
+    self.directory = directory
+    self.maxEntries = maxEntries
+    self.maxDiskBytes = maxDiskBytes
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def fileName(self, key):
+    return os.path.join(self.directory, key + '.npz')
+
+  def get(self, key):
+    """The cached statistics of key, or None"""
+    stats = self.entries.pop(key, None)
+    if stats is None and self.directory:
+      stats = self.load(key)
+    if stats is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.remember(key, stats)
+    return stats
+
+  def put(self, key, stats):
+    self.entries.pop(key, None)
+    self.remember(key, stats)
+    if self.directory:
+      self.save(key, stats)
+
+  def remember(self, key, stats):
+    self.entries[key] = stats
+    while len(self.entries) > self.maxEntries:
+      self.entries.popitem(last=False)
+
+  def load(self, key):
+    fileName = self.fileName(key)
+    try:
+      with np.load(fileName) as data:
+        stats = dict((field, data[field]) for field in STATS_FIELDS)
+      os.utime(fileName, None)
+    except (IOError, OSError, KeyError, ValueError):
+      return None
+    stats['total'] = stats['total'][()]
+    return stats
+
+  def save(self, key, stats):
+    """Write stats next to their final name and rename, so readers never
+    see a partly written file. A cache that cannot be written is skipped."""
+    fileName = self.fileName(key)
+    try:
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+      with open(fileName + '.tmp', 'wb') as fp:
+        np.savez(fp, **dict((field, np.asarray(stats[field])) for field in STATS_FIELDS))
+      replaceFile(fileName + '.tmp', fileName)
+    except (IOError, OSError):
+      return
+    self.evict()
+
+  def diskEntries(self):
+    """(modification time, bytes, file name) of the cache files, oldest first"""
+    entries = []
+    for name in os.listdir(self.directory):
+      if name.endswith('.npz'):
+        fileName = os.path.join(self.directory, name)
+        stat = os.stat(fileName)
+        entries.append((stat.st_mtime, stat.st_size, fileName))
+    return sorted(entries)
+
+  def diskBytes(self):
+    if not self.directory or not os.path.isdir(self.directory):
+      return 0
+    return sum(entry[1] for entry in self.diskEntries())
+
+  def evict(self):
+    entries = self.diskEntries()
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, fileName in entries:
+      if total <= self.maxDiskBytes:
+        break
+      try:
+        os.remove(fileName)
+      except OSError:
+        pass
+      total -= size
+
+  def clear(self):
+    """Forget the memory cache and remove the cache files"""
+    self.entries.clear()
+    if self.directory and os.path.isdir(self.directory):
+      for mtime, size, fileName in self.diskEntries():
+        os.remove(fileName)
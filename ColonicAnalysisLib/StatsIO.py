@@ -0,0 +1,198 @@
+import csv
+import os
+
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
+
+import numpy as np
+
+from .LabelStatistics import CC_PER_CUBIC_MM, COLON_REGIONS, STATS_KEYS, voxelVolume
+
+__all__ = ['statsAsCSV', 'transitColumns', 'transitRows', 'transitTableAsCSV',
+           'transitRecords', 'writeStatsCSV', 'writeStatsNPZ', 'writeStatsParquet',
+           'saveStatsFile', 'sweepAsCSV', 'intervalsAsCSV', 'STATS_FORMATS']
+
+# file extension -> writer, see saveStatsFile
+STATS_FORMATS = ('.csv', '.npz', '.parquet')
+
+
+def writeHeader(fp, keys):
+  """Header line with the keys in quotes, as the module has always written it"""
+  fp.write(",".join("\"%s\"" % k for k in keys) + "\n")
+
+
+def statsAsCSV(labelStats, keys=STATS_KEYS):
+  """
+  comma separated values with header keys in quotes
+  """
+  fp = StringIO()
+  writeHeader(fp, keys)
+  writer = csv.writer(fp, lineterminator='\n')
+  for i in labelStats["Labels"]:
+    writer.writerow([labelStats[i, k] for k in keys])
+  return fp.getvalue()
+
+
+def transitColumns(regions=COLON_REGIONS[:-1]):
+  columns = ["Timepoint", "Total Counts", "Geometric Centre"]
+  for region in regions:
+    columns += ["%s Voxels" % region, "%s Volume cc" % region, "%s Counts" % region]
+  return columns
+
+
+def transitRows(transit, timepoints, spacings, regions=COLON_REGIONS[:-1]):
+  """One list of values per timepoint, in transitColumns order"""
+  for t, tp in enumerate(timepoints):
+    cubicMMPerVoxel = voxelVolume(spacings[t])
+    row = [tp, transit['total'][t], "%2.3f" % transit['geometricCentre'][t]]
+    for label in range(1, len(regions) + 1):
+      voxels = transit['voxels'][t, label]
+      row += [voxels, "%2.3f" % (voxels * cubicMMPerVoxel * CC_PER_CUBIC_MM), transit['counts'][t, label]]
+    yield row
+
+
+def transitTableAsCSV(transit, timepoints, spacings):
+  """
+  comma separated values, one row per timepoint, header keys in quotes
+  """
+  fp = StringIO()
+  writeHeader(fp, transitColumns())
+  csv.writer(fp, lineterminator='\n').writerows(transitRows(transit, timepoints, spacings))
+  return fp.getvalue()
+
+
+def sweepAsCSV(sweeps, timepoints, spacings):
+  """
+  comma separated values of thresholdSweep output, one row per timepoint
+  and threshold, header keys in quotes
+  """
+  fp = StringIO()
+  columns = transitColumns()
+  writeHeader(fp, columns[:1] + ["Threshold"] + columns[1:])
+  writer = csv.writer(fp, lineterminator='\n')
+  for sweep, tp, spacing in zip(sweeps, timepoints, spacings):
+    numThresholds = len(sweep['thresholds'])
+    rows = transitRows(sweep, [tp] * numThresholds, [spacing] * numThresholds)
+    for threshold, row in zip(sweep['thresholds'], rows):
+      writer.writerow(row[:1] + [threshold] + row[1:])
+  return fp.getvalue()
+
+
+def intervalsAsCSV(transit, intervals, timepoints, regions=COLON_REGIONS[:-1]):
+  """
+  comma separated values of the geometric centre and the fraction of the
+  total counts of every region with their bootstrapStatistics intervals,
+  one row per timepoint, header keys in quotes
+  """
+  fp = StringIO()
+  columns = ["Timepoint", "Geometric Centre", "Geometric Centre Low", "Geometric Centre High"]
+  for region in regions:
+    columns += ["%s Fraction" % region, "%s Fraction Low" % region, "%s Fraction High" % region]
+  writeHeader(fp, columns)
+  writer = csv.writer(fp, lineterminator='\n')
+  for t, tp in enumerate(timepoints):
+    low, high = intervals[t]['geometricCentre']
+    row = [tp, "%2.3f" % transit['geometricCentre'][t], "%2.3f" % low, "%2.3f" % high]
+    total = float(transit['total'][t]) or 1.0
+    for label in range(1, len(regions) + 1):
+      low, high = intervals[t]['fraction'][label]
+      row += ["%.4f" % (transit['counts'][t, label] / total), "%.4f" % low, "%.4f" % high]
+    writer.writerow(row)
+  return fp.getvalue()
+
+
+def transitRecords(transit, timepoints, spacings):
+  """Columnar form of stackStatistics output.
+  Returns (records, summary): records has one row per timepoint and label
+  from 1 with the fields timepoint, label, voxels, volume (cc), counts and
+  mean (the label's share of the geometric centre); summary has one row
+  per timepoint with the fields timepoint, voxels, volume, counts (the
+  total counts) and geometricCentre.
+  """
+  numTimepoints, numLabels = transit['counts'].shape
+  labels = np.arange(1, numLabels)
+  volumes = np.array([voxelVolume(s) * CC_PER_CUBIC_MM for s in spacings]).reshape(-1, 1)
+  total = np.asarray(transit['total'], dtype=np.float64).reshape(-1, 1)
+  mean = transit['counts'][:, 1:] * labels / np.where(total > 0, total, 1.0)
+  records = np.zeros(numTimepoints * (numLabels - 1), dtype=[
+    ('timepoint', 'U8'), ('label', np.int32), ('voxels', np.int64), ('volume', np.float64),
+    ('counts', transit['counts'].dtype), ('mean', np.float64)])
+  records['timepoint'] = np.repeat(np.array(timepoints, dtype='U8'), numLabels - 1)
+  records['label'] = np.tile(labels, numTimepoints)
+  records['voxels'] = transit['voxels'][:, 1:].ravel()
+  records['volume'] = (transit['voxels'][:, 1:] * volumes).ravel()
+  records['counts'] = transit['counts'][:, 1:].ravel()
+  records['mean'] = mean.ravel()
+  summary = np.zeros(numTimepoints, dtype=[
+    ('timepoint', 'U8'), ('voxels', np.int64), ('volume', np.float64),
+    ('counts', transit['counts'].dtype), ('geometricCentre', np.float64)])
+  summary['timepoint'] = timepoints
+  summary['voxels'] = transit['voxels'][:, 1:].sum(axis=1)
+  summary['volume'] = (transit['voxels'][:, 1:] * volumes).sum(axis=1)
+  summary['counts'] = transit['total']
+  summary['geometricCentre'] = transit['geometricCentre']
+  return records, summary
+
+
+def writeStatsCSV(fp, records, summary):
+  """Stream the label rows of every timepoint to the open file fp, each
+  timepoint followed by a Total row holding the total counts and the
+  geometric centre in the SPECT Mean column, as in the stats table.
+  records and summary are in the same timepoint order, as transitRecords
+  returns them, and are written in a single pass."""
+  writeHeader(fp, ("Timepoint",) + STATS_KEYS)
+  writer = csv.writer(fp, lineterminator='\n')
+
+  def writeTotal(total):
+    writer.writerow([total['timepoint'], "Total", total['voxels'], "%2.3f" % total['volume'],
+                     total['counts'], "%2.3f" % total['geometricCentre']])
+
+  totals = iter(summary)
+  total = next(totals, None)
+  for record in records:
+    while total is not None and total['timepoint'] != record['timepoint']:
+      writeTotal(total)
+      total = next(totals, None)
+    writer.writerow([record['timepoint'], record['label'], record['voxels'], "%2.3f" % record['volume'],
+                     record['counts'], "%2.3f" % record['mean']])
+  while total is not None:
+    writeTotal(total)
+    total = next(totals, None)
+
+
+def writeStatsNPZ(fileName, records, summary):
+  """Compressed NumPy columnar file with one array per field, the summary
+  fields prefixed with total_"""
+  columns = dict((name, records[name]) for name in records.dtype.names)
+  columns.update(('total_' + name, summary[name]) for name in summary.dtype.names)
+  np.savez_compressed(fileName, **columns)
+
+
+def writeStatsParquet(fileName, records, summary):
+  """Parquet file of the label rows, with the per timepoint totals joined on.
+  Needs pyarrow."""
+  try:
+    import pyarrow
+    import pyarrow.parquet
+  except ImportError:
+    raise ImportError("Saving statistics as Parquet needs pyarrow, save as .npz instead")
+  row = dict((tp, t) for t, tp in enumerate(summary['timepoint']))
+  index = np.array([row[tp] for tp in records['timepoint']], dtype=np.intp)
+  columns = dict((name, records[name]) for name in records.dtype.names)
+  columns['totalCounts'] = summary['counts'][index]
+  columns['geometricCentre'] = summary['geometricCentre'][index]
+  pyarrow.parquet.write_table(pyarrow.table(columns), fileName)
+
+
+def saveStatsFile(fileName, records, summary):
+  """Write the statistics in the format given by the file extension"""
+  extension = os.path.splitext(fileName)[1].lower()
+  if extension == '.npz':
+    writeStatsNPZ(fileName, records, summary)
+  elif extension == '.parquet':
+    writeStatsParquet(fileName, records, summary)
+  else:
+    with open(fileName, 'w') as fp:
+      writeStatsCSV(fp, records, summary)
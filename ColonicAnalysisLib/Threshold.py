@@ -0,0 +1,116 @@
+import numpy as np
+
+from .LabelStatistics import slabSize
+
+__all__ = ['VolumeHistogram', 'backgroundThreshold', 'buildThresholdIndex', 'thresholdVoxels']
+
+# working memory per voxel of a histogram pass: the intp bin numbers
+# bincount works on, and about three times that for np.histogram
+HISTOGRAM_BYTES_PER_VOXEL = {'integer': 8, 'float': 24}
+
+
+class VolumeHistogram(object):
+  """Voxel value histogram of a volume array plus its cumulative sums, so that
+  the maximum, percentiles and the fraction of counts above a threshold are
+  lookups instead of scans of the volume.
+  Integer data is binned per value with bincount, other data in fixed bins.
+  With maxBytes the volume is binned in slabs of k slices whose working
+  memory stays under maxBytes, as in labelStatistics.
+  """
+  def __init__(self, array, bins=4096, maxBytes=None):
+    self.minimum = array.min()
+    self.maximum = array.max()
+    integer = array.dtype.kind in 'iub'
+    if maxBytes is None:
+      slabs = [array]
+    else:
+      step = slabSize(array.shape, maxBytes, HISTOGRAM_BYTES_PER_VOXEL['integer' if integer else 'float'])
+      slabs = (array[k:k + step] for k in range(0, array.shape[0], step))
+    if integer:
+      self.offset = min(int(self.minimum), 0)
+      self.binWidth = 1.0
+      self.counts = np.zeros(int(self.maximum) - self.offset + 1, dtype=np.int64)
+      for slab in slabs:
+        flat = slab.ravel()
+        if self.offset < 0:
+          flat = np.subtract(flat, self.offset, dtype=np.int64)
+        self.counts += np.bincount(flat, minlength=self.counts.size)
+      values = np.arange(self.counts.size) + self.offset
+    else:
+      self.counts = np.zeros(bins, dtype=np.int64)
+      valueRange = (float(self.minimum), float(self.maximum))
+      for slab in slabs:
+        counts, edges = np.histogram(slab, bins=bins, range=valueRange)
+        self.counts += counts
+      self.offset = edges[0]
+      self.binWidth = edges[1] - edges[0]
+      values = (edges[:-1] + edges[1:]) / 2.0
+    self.cumCounts = np.cumsum(self.counts)
+    self.cumWeights = np.cumsum(self.counts * values)
+
+  def binEdge(self, i, bins=100):
+    """Lower edge of bin i of a histogram with bins equal width bins,
+    as returned by np.histogram(array, bins). The range is taken in floating
+    point, in the volume's type it can overflow."""
+    minimum = float(self.minimum)
+    return minimum + i * (float(self.maximum) - minimum) / bins
+
+  def binIndex(self, value):
+    """Index of the first bin whose values are all >= value"""
+    i = int(np.ceil((value - self.offset) / self.binWidth))
+    return min(max(i, 0), self.counts.size)
+
+  def percentile(self, p):
+    """Voxel value below which p percent of the voxels lie"""
+    i = np.searchsorted(self.cumCounts, self.cumCounts[-1] * p / 100.0, side='right')
+    return self.offset + min(i, self.counts.size - 1) * self.binWidth
+
+  def fractionAbove(self, value):
+    """Fraction of the total counts in voxels with a value >= value"""
+    total = self.cumWeights[-1]
+    if not total:
+      return 0.0
+    i = self.binIndex(value)
+    below = self.cumWeights[i - 1] if i > 0 else 0
+    return (total - below) / float(total)
+
+
+def backgroundThreshold(hist):
+  """Default threshold removing the SPECT background: the lower edge of the
+  10th bin of a 100 bin histogram of the volume"""
+  return hist.binEdge(9, 100)
+
+
+def buildThresholdIndex(arrayv):
+  """Sort the SPECT voxel offsets by value so that a threshold change only
+  has to touch the voxels lying between the old and new threshold.
+  """
+  flat = arrayv.ravel()
+  order = np.argsort(flat, kind='mergesort')
+  if flat.size <= np.iinfo(np.uint32).max:
+    # half the memory of the intp offsets argsort returns
+    order = order.astype(np.uint32)
+  return {'order': order, 'values': flat[order], 'applied': None}
+
+
+def thresholdVoxels(arrayv, arrayt, thrsh, index=None):
+  """Write arrayv into arrayt with voxels below thrsh set to 0, like the
+  thresholdscalarvolume 'Below' mode. With a sorted voxel index only the
+  voxels between the previously applied threshold and thrsh are rewritten.
+  Returns False if arrayt was already thresholded at thrsh.
+  """
+  if index and index['applied'] is not None and index['order'].size == arrayt.size:
+    if thrsh == index['applied']:
+      return False
+    lo, hi = sorted((index['applied'], thrsh))
+    start, stop = np.searchsorted(index['values'], [lo, hi])
+    changed = index['order'][start:stop]
+    if thrsh > index['applied']:
+      arrayt.ravel()[changed] = 0
+    else:
+      arrayt.ravel()[changed] = index['values'][start:stop]
+  else:
+    np.multiply(arrayv, arrayv >= thrsh, out=arrayt, casting='unsafe')
+  if index:
+    index['applied'] = thrsh
+  return True
@@ -0,0 +1,152 @@
+import gzip
+import io
+import os
+
+import numpy as np
+
+__all__ = ['readNrrd', 'writeNrrd']
+
+NRRD_TYPES = {
+  'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+  'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+  'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2',
+  'int16': 'i2', 'int16_t': 'i2',
+  'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2',
+  'uint16': 'u2', 'uint16_t': 'u2',
+  'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+  'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+  'longlong': 'i8', 'long long': 'i8', 'long long int': 'i8', 'signed long long': 'i8',
+  'signed long long int': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+  'ulonglong': 'u8', 'unsigned long long': 'u8', 'unsigned long long int': 'u8',
+  'uint64': 'u8', 'uint64_t': 'u8',
+  'float': 'f4', 'double': 'f8',
+}
+
+
+def readNrrdHeader(fp):
+  """Read the header fields of an open NRRD file, leaving fp at the data"""
+  magic = fp.readline()
+  if not magic.startswith(b'NRRD'):
+    raise IOError("Not a NRRD file")
+  header = {}
+  while True:
+    line = fp.readline()
+    if not line or not line.strip():
+      break
+    line = line.decode('latin-1').rstrip('\r\n')
+    if line.startswith('#') or ':=' in line:
+      continue
+    field, value = line.split(':', 1)
+    header[field.strip().lower()] = value.strip()
+  return header
+
+
+def nrrdSpacing(header):
+  """Voxel spacing (x, y, z) from the space directions or spacings field"""
+  if 'space directions' in header:
+    vectors = []
+    for vector in header['space directions'].split():
+      if vector == 'none':
+        continue
+      vectors.append([float(v) for v in vector.strip('()').split(',')])
+    return tuple(float(np.sqrt((np.array(v) ** 2).sum())) for v in vectors)
+  if 'spacings' in header:
+    return tuple(float(v) for v in header['spacings'].split() if v.lower() != 'nan')
+  return (1.0,) * int(header['dimension'])
+
+
+def readNrrd(fileName, mmap=False):
+  """Read a raw or gzip encoded NRRD volume.
+  Returns (array, spacing), the array indexed [k, j, i] like slicer.util.array
+  and the spacing in (x, y, z) order like vtkMRMLVolumeNode.GetSpacing().
+  With mmap a raw payload is memory mapped read only instead of read, so
+  only the pages that are used are loaded and processes reading the same
+  file share them in the page cache. Compressed payloads are always read.
+  """
+  with open(fileName, 'rb') as fp:
+    header = readNrrdHeader(fp)
+    sizes = [int(v) for v in header['sizes'].split()]
+    dtype = np.dtype(NRRD_TYPES[header['type']])
+    if dtype.itemsize > 1:
+      dtype = dtype.newbyteorder('>' if header.get('endian') == 'big' else '<')
+    encoding = header.get('encoding', 'raw')
+    if 'data file' in header:
+      dataFile, offset = os.path.join(os.path.dirname(fileName), header['data file']), 0
+    else:
+      dataFile, offset = fileName, fp.tell()
+    if mmap and encoding == 'raw':
+      return mapPayload(dataFile, offset, header, sizes, dtype), nrrdSpacing(header)
+    if dataFile != fileName:
+      with open(dataFile, 'rb') as dfp:
+        payload = dfp.read()
+    else:
+      payload = fp.read()
+  if encoding in ('gzip', 'gz'):
+    payload = gzip.GzipFile(fileobj=io.BytesIO(payload)).read()
+  elif encoding != 'raw':
+    raise IOError("Unsupported NRRD encoding %s" % encoding)
+  count = int(np.prod(sizes))
+  skip = int(header.get('byte skip', 0))
+  if skip < 0:
+    skip = len(payload) - count * dtype.itemsize
+  array = np.frombuffer(payload, dtype=dtype, count=count, offset=skip)
+  array = array.reshape(sizes[::-1]).astype(dtype.newbyteorder('='))
+  return array, nrrdSpacing(header)
+
+
+def mapPayload(dataFile, offset, header, sizes, dtype):
+  """Read only memory map of a raw payload starting at offset, indexed [k, j, i].
+  Big endian data keeps its byte order, NumPy converts it as it is read."""
+  count = int(np.prod(sizes))
+  skip = int(header.get('byte skip', 0))
+  if skip < 0:
+    offset = os.path.getsize(dataFile) - count * dtype.itemsize
+  else:
+    offset += skip
+  return np.memmap(dataFile, dtype=dtype, mode='r', offset=offset, shape=tuple(sizes[::-1]))
+
+
+def writeNrrd(fileName, array, spacing, encoding='raw'):
+  """Write an array indexed [k, j, i] with (x, y, z) spacing as a NRRD volume"""
+  names = dict((v, k) for k, v in NRRD_TYPES.items() if k in (
+    'int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32', 'int64', 'uint64', 'float', 'double'))
+  dtype = array.dtype.newbyteorder('<') if array.dtype.itemsize > 1 else array.dtype
+  lines = ["NRRD0004",
+           "type: %s" % names[dtype.str[1:]],
+           "dimension: %d" % array.ndim,
+           "space: left-posterior-superior",
+           "sizes: %s" % " ".join(str(n) for n in array.shape[::-1]),
+           "space directions: %s" % " ".join(
+             "(%s)" % ",".join(repr(float(spacing[i])) if j == i else "0" for j in range(array.ndim))
+             for i in range(array.ndim)),
+           "kinds: %s" % " ".join(["domain"] * array.ndim),
+           "endian: little",
+           "encoding: %s" % encoding,
+           "space origin: (%s)" % ",".join(["0"] * array.ndim)]
+  payload = np.ascontiguousarray(array, dtype=dtype).tobytes()
+  if encoding == 'gzip':
+    payload = _gzip(payload)
+  with open(fileName, 'wb') as fp:
+    fp.write(("\n".join(lines) + "\n\n").encode('latin-1'))
+    fp.write(payload)
+
+
+def replaceFile(source, destination):
+  """Move source over destination in one step, so readers of destination
+  always find either the old or the new file"""
+  if hasattr(os, 'replace'):
+    os.replace(source, destination)
+  elif os.name == 'posix':
+    os.rename(source, destination)
+  else:
+    # Python 2 on Windows cannot rename over an existing file
+    if os.path.exists(destination):
+      os.remove(destination)
+    os.rename(source, destination)
+
+
+def _gzip(payload):
+  buf = io.BytesIO()
+  with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+    gz.write(payload)
+  return buf.getvalue()
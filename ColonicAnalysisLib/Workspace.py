@@ -0,0 +1,68 @@
+"""Workspace snapshots of a study in progress.
+
+A snapshot is one compressed .npz file holding the study state as JSON
+(thresholds and references to the source volumes, see the logic's
+saveSnapshot) and the painted label maps. The SPECT and CT volumes are not
+copied and the threshold volumes are not stored at all, they are made
+again from the SPECT volume and the saved threshold. Each label map is
+cropped to the block holding its labels and stored as uint8 where the
+labels fit, so a snapshot is usually a few hundred kB.
+"""
+import json
+
+import numpy as np
+
+from .Memory import LABEL_DTYPE
+
+__all__ = ['SNAPSHOT_VERSION', 'labelExtent', 'writeSnapshot', 'readSnapshot']
+
+SNAPSHOT_VERSION = 1
+
+
+def labelExtent(arrayl):
+  """(start, stop) of the block of arrayl holding its non zero labels along
+  each axis, or None if it has none"""
+  extent = []
+  for axis in range(arrayl.ndim):
+    others = tuple(a for a in range(arrayl.ndim) if a != axis)
+    nonZero = np.flatnonzero(arrayl.any(axis=others))
+    if not nonZero.size:
+      return None
+    extent.append((int(nonZero[0]), int(nonZero[-1]) + 1))
+  return extent
+
+
+def writeSnapshot(fileName, state, labels):
+  """Write the JSON serialisable state dict and the {timepoint: [k, j, i]
+  label array} labels to fileName"""
+  state = dict(state, version=SNAPSHOT_VERSION, labels={})
+  arrays = {}
+  for timePoint, arrayl in labels.items():
+    extent = labelExtent(arrayl)
+    dtype = arrayl.dtype
+    if extent and arrayl.max() <= np.iinfo(LABEL_DTYPE).max and arrayl.min() >= 0:
+      dtype = LABEL_DTYPE
+    state['labels'][timePoint] = {'shape': list(arrayl.shape), 'dtype': str(arrayl.dtype), 'extent': extent}
+    if extent:
+      block = tuple(slice(start, stop) for start, stop in extent)
+      arrays['label_' + timePoint] = arrayl[block].astype(dtype)
+  arrays['state'] = np.frombuffer(json.dumps(state, sort_keys=True).encode('utf-8'), dtype=np.uint8)
+  with open(fileName, 'wb') as fp:
+    np.savez_compressed(fp, **arrays)
+
+
+def readSnapshot(fileName):
+  """Returns (state, labels) as passed to writeSnapshot, the label arrays
+  in their original shape and type"""
+  with np.load(fileName) as data:
+    state = json.loads(data['state'].tobytes().decode('utf-8'))
+    if state.get('version', 0) > SNAPSHOT_VERSION:
+      raise IOError("%s was written by a newer version of the module" % fileName)
+    labels = {}
+    for timePoint, label in state['labels'].items():
+      arrayl = np.zeros(label['shape'], dtype=label['dtype'])
+      if label['extent']:
+        block = tuple(slice(start, stop) for start, stop in label['extent'])
+        arrayl[block] = data['label_' + timePoint]
+      labels[str(timePoint)] = arrayl
+  return state, labels
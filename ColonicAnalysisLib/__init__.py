@@ -0,0 +1,17 @@
+"""Slicer independent core of the ColonicAnalysis module.
+
+Everything in this package works on NumPy arrays plus voxel spacing and can
+be imported, tested and benchmarked without a running Slicer.
+"""
+from .Naming import *
+from .Parallel import *
+from .Profiling import *
+from .Threshold import *
+from .LabelStatistics import *
+from .Memory import *
+from .Bootstrap import *
+from .StatsCache import *
+from .StatsIO import *
+from .VolumeIO import *
+from .Workspace import *
+from .Dicom import *
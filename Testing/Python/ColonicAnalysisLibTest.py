@@ -0,0 +1,252 @@
+"""Tests of the Slicer independent ColonicAnalysisLib package.
+
+They only need NumPy and run with plain Python from the module directory:
+
+  python -m unittest discover -s Testing/Python -p "*Test.py"
+
+The tests of the logic on a MRML scene are in ColonicAnalysisTest.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from ColonicAnalysisLib import Batch
+from ColonicAnalysisLib.Benchmark import makePhantom
+from ColonicAnalysisLib.Bootstrap import bootstrapCounts, bootstrapStatistics
+from ColonicAnalysisLib.LabelStatistics import (COLON_REGIONS, LabelStatsTracker, geometricCentre, labelStatistics,
+                                                stackStatistics, statsTable, sweepThresholds, thresholdSweep)
+from ColonicAnalysisLib.Naming import TIMEPOINTS
+from ColonicAnalysisLib.StatsCache import StatsCache, statsKey
+from ColonicAnalysisLib.StatsIO import intervalsAsCSV, saveStatsFile, statsAsCSV, sweepAsCSV, transitRecords, transitTableAsCSV
+from ColonicAnalysisLib.Threshold import VolumeHistogram, backgroundThreshold, buildThresholdIndex, thresholdVoxels
+from ColonicAnalysisLib.VolumeIO import readNrrd, writeNrrd
+from ColonicAnalysisLib.Workspace import labelExtent, readSnapshot, writeSnapshot
+
+
+class ColonicAnalysisLibTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix='ColonicAnalysisLibTest')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def test_LabelStatistics(self):
+    """ Check the NumPy label statistics against a small hand made volume.
+    """
+    arrayv = np.zeros((2,3,4), dtype=np.int16)
+    arrayl = np.zeros((2,3,4), dtype=np.int16)
+    arrayv[0,0,:] = 10
+    arrayl[0,0,:2] = 1
+    arrayl[0,0,2:] = 3
+    arrayl[1,2,3] = 3
+    stats = labelStatistics(arrayv, arrayl, len(COLON_REGIONS))
+    self.assertEqual(list(stats['voxels'][:4]), [0, 2, 0, 2])
+    self.assertEqual(list(stats['counts'][:4]), [0, 20, 0, 20])
+    self.assertEqual(stats['total'], 40)
+    self.assertAlmostEqual(stats['mean'].sum(), 2.0)
+    self.assertAlmostEqual(geometricCentre(stats['counts']), 2.0)
+    labelStats, totalCounts, computedMean = statsTable(stats, (2.0, 2.0, 2.5))
+    self.assertEqual(labelStats[1, "Volume cc"], "0.020")
+    self.assertEqual(statsAsCSV(labelStats).splitlines()[1], "1,2,0.020,20,0.500")
+
+  def test_Threshold(self):
+    """ Incremental thresholding must match thresholding from scratch.
+    """
+    arrayv = np.arange(60, dtype=np.int16).reshape((3,4,5)) % 17
+    arrayt = arrayv.copy()
+    hist = VolumeHistogram(arrayv)
+    self.assertEqual(hist.maximum, 16)
+    self.assertAlmostEqual(backgroundThreshold(hist), np.histogram(arrayv, bins=100)[1][9])
+    index = buildThresholdIndex(arrayv)
+    for thrsh in (5, 12, 3, 3, 16, 0):
+      thresholdVoxels(arrayv, arrayt, thrsh, index)
+      self.assertTrue((arrayt == np.where(arrayv < thrsh, 0, arrayv)).all())
+    self.assertEqual([hist.binIndex(v) for v in (-3, 0, 5, 100)], [0, 0, 5, 17])
+    ordered = np.sort(arrayv.ravel())
+    for p in (0, 10, 50, 90, 100):
+      self.assertEqual(hist.percentile(p), ordered[min(ordered.size * p // 100, ordered.size - 1)])
+    for thrsh in (0, 5, 16, 17):
+      self.assertAlmostEqual(hist.fractionAbove(thrsh), arrayv[arrayv >= thrsh].sum() / float(arrayv.sum()))
+    wideRange = np.array([-30000, 0, 30000], dtype=np.int16)
+    self.assertAlmostEqual(backgroundThreshold(VolumeHistogram(wideRange)), np.histogram(wideRange, bins=100)[1][9])
+    for volume in (arrayv - 4, arrayv.astype(np.uint8), arrayv * 0.5):
+      whole = VolumeHistogram(volume)
+      slabbed = VolumeHistogram(volume, maxBytes=1)
+      self.assertTrue(np.array_equal(slabbed.counts, whole.counts))
+      self.assertEqual((slabbed.offset, slabbed.binWidth), (whole.offset, whole.binWidth))
+
+  def test_TransitStatistics(self):
+    """ The all-timepoint table must match the per timepoint statistics, also
+    when these are computed in slabs.
+    """
+    arraysv = [np.arange(60, dtype=np.int16).reshape((3,4,5)) % (7 + t) for t in range(3)]
+    arraysl = [(np.arange(60, dtype=np.int16).reshape((3,4,5)) + t) % 10 for t in range(3)]
+    statsList = [labelStatistics(v, l, len(COLON_REGIONS)) for v, l in zip(arraysv, arraysl)]
+    transit = stackStatistics(statsList)
+    for t, stats in enumerate(statsList):
+      self.assertEqual(list(transit['counts'][t]), list(stats['counts']))
+      self.assertEqual(list(transit['voxels'][t]), list(stats['voxels']))
+      self.assertAlmostEqual(transit['geometricCentre'][t], stats['mean'].sum())
+    for maxBytes in (1, 2000):
+      chunked = stackStatistics([labelStatistics(v, l, len(COLON_REGIONS), maxBytes) for v, l in zip(arraysv, arraysl)])
+      for key in ('voxels', 'counts', 'total', 'geometricCentre'):
+        self.assertTrue(np.array_equal(chunked[key], transit[key]))
+    csv = transitTableAsCSV(transit, TIMEPOINTS, [(1.0, 1.0, 1.0)] * 3)
+    self.assertEqual(len(csv.splitlines()), 4)
+    records, summary = transitRecords(transit, TIMEPOINTS, [(1.0, 1.0, 1.0)] * 3)
+    self.assertEqual(len(records), 3 * (len(COLON_REGIONS) - 1))
+    self.assertEqual(list(summary['counts']), list(transit['total']))
+    fileName = os.path.join(self.directory, 'ColonicAnalysisStats.csv')
+    saveStatsFile(fileName, records, summary)
+    with open(fileName) as fp:
+      lines = fp.read().splitlines()
+    self.assertEqual(len(lines), 1 + len(records) + len(summary))
+    self.assertTrue(lines[len(COLON_REGIONS)].startswith("6HRS,Total,"))
+
+  def test_ThresholdSweep(self):
+    """ A threshold sweep must match the statistics of the thresholded volume.
+    """
+    phantom = makePhantom(32, countLevel=100)
+    arrayv, arrayl = phantom['SP'], phantom['LA']
+    thresholds = sweepThresholds(20, arrayv.max())
+    self.assertEqual(thresholds[0], 0)
+    self.assertEqual(thresholds[-1], 60)
+    sweep = thresholdSweep(arrayv, arrayl, len(COLON_REGIONS), thresholds)
+    for i in (0, 10, 20, len(thresholds) - 1):
+      thresholded = np.where(arrayv >= thresholds[i], arrayv, 0)
+      stats = labelStatistics(thresholded, arrayl, len(COLON_REGIONS))
+      self.assertEqual(list(sweep['counts'][i][1:]), list(stats['counts'][1:]))
+      self.assertEqual(list(sweep['voxels'][i][1:]), list(stats['voxels'][1:]))
+      self.assertAlmostEqual(sweep['geometricCentre'][i], stats['mean'].sum())
+    csv = sweepAsCSV([sweep], TIMEPOINTS[:1], [phantom['spacing']])
+    self.assertEqual(len(csv.splitlines()), 1 + len(thresholds))
+
+  def test_Bootstrap(self):
+    """ Bootstrap intervals are reproducible for a seed whatever the thread
+    count, hold the point estimates and narrow as the counts grow.
+    """
+    phantom = makePhantom(32, countLevel=100)
+    stats = labelStatistics(phantom['SP'], phantom['LA'], len(COLON_REGIONS))
+    intervals = bootstrapStatistics(stats['counts'], 1000, seed=7, blockSize=300, maxWorkers=3)
+    serial = bootstrapStatistics(stats['counts'], 1000, seed=7, blockSize=300, maxWorkers=1)
+    self.assertTrue(np.array_equal(intervals['fraction'], serial['fraction']))
+    self.assertEqual(bootstrapCounts(stats['counts'], 1000, seed=7, blockSize=300).shape, (1000, len(COLON_REGIONS)))
+    low, high = intervals['geometricCentre']
+    self.assertTrue(low <= stats['mean'].sum() <= high)
+    fraction = stats['counts'][1] / float(stats['total'])
+    self.assertTrue(intervals['fraction'][1][0] <= fraction <= intervals['fraction'][1][1])
+    narrow = bootstrapStatistics(stats['counts'] * 100, 1000, seed=7)
+    self.assertLess(np.diff(narrow['geometricCentre'])[0], high - low)
+    transit = stackStatistics([stats])
+    csv = intervalsAsCSV(transit, [intervals], TIMEPOINTS[:1])
+    self.assertEqual(len(csv.splitlines()), 2)
+
+  def test_StatsCache(self):
+    """ Cached label statistics are found by content, also by a new cache on the
+    same directory, and the files stay within the size bound.
+    """
+    arrayv = np.arange(240, dtype=np.int16).reshape((4,6,10)) % 13
+    arrayl = (np.arange(240, dtype=np.int16).reshape((4,6,10)) // 7) % len(COLON_REGIONS)
+    key = statsKey(arrayv, arrayl, (4.0, 4.0, 4.0), len(COLON_REGIONS))
+    self.assertEqual(key, statsKey(arrayv.copy(), arrayl.copy(), (4.0, 4.0, 4.0), len(COLON_REGIONS)))
+    self.assertNotEqual(key, statsKey(arrayv, arrayl, (4.0, 4.0, 3.5), len(COLON_REGIONS)))
+    painted = arrayl.copy()
+    painted[1, 2, 3] = 1
+    self.assertNotEqual(key, statsKey(arrayv, painted, (4.0, 4.0, 4.0), len(COLON_REGIONS)))
+    directory = os.path.join(self.directory, 'StatsCache')
+    cache = StatsCache(directory, maxEntries=2, maxDiskBytes=4096)
+    stats = labelStatistics(arrayv, arrayl, len(COLON_REGIONS))
+    cache.put(key, stats)
+    restored = StatsCache(directory).get(key)
+    for field in stats:
+      self.assertTrue(np.array_equal(restored[field], stats[field]))
+    for n in range(8):
+      cache.put('%s-%d' % (key, n), stats)
+    self.assertEqual(len(cache.entries), 2)
+    self.assertTrue(0 < cache.diskBytes() <= 4096)
+    cache.clear()
+    self.assertEqual(cache.diskBytes(), 0)
+
+  def test_Snapshot(self):
+    """ A snapshot file gives back the label maps in their shape and type.
+    """
+    labels = np.arange(4096, dtype=np.uint8).reshape((16, 16, 16)) % 3
+    labels[:4] = 0
+    extent = labelExtent(labels)
+    self.assertEqual(extent[0], (4, 16))
+    fileName = os.path.join(self.directory, 'ColonicAnalysisSnapshot.npz')
+    writeSnapshot(fileName, {'timepoints': {}}, {'6HRS': labels, '24HRS': np.zeros((2, 3, 4), np.int16)})
+    state, restored = readSnapshot(fileName)
+    self.assertTrue(np.array_equal(restored['6HRS'], labels))
+    self.assertEqual(restored['24HRS'].dtype, np.int16)
+
+  def test_LabelStatsTracker(self):
+    """ Incremental label statistics must match a full recount after painting.
+    """
+    arrayv = np.arange(240, dtype=np.int16).reshape((4,6,10)) % 13
+    arrayl = np.zeros((4,6,10), dtype=np.int16)
+    tracker = LabelStatsTracker(arrayv, arrayl, len(COLON_REGIONS))
+    for label, block in ((2, (0, slice(1,3), slice(2,6))), (5, (slice(1,4), 2, slice(0,9))), (0, (1, 2, 3))):
+      arrayl[block] = label
+      self.assertTrue(tracker.update(arrayl))
+      stats = labelStatistics(arrayv, arrayl, len(COLON_REGIONS))
+      self.assertEqual(list(tracker.stats()['counts']), list(stats['counts']))
+      self.assertEqual(list(tracker.stats()['voxels']), list(stats['voxels']))
+    self.assertFalse(tracker.update(arrayl))
+
+  def test_VolumeIO(self):
+    """ Memory mapped NRRD volumes give the same statistics as ones read into memory.
+    """
+    phantom = makePhantom(24)
+    fileName = os.path.join(self.directory, 'ColonicAnalysisPhantom.nrrd')
+    writeNrrd(fileName, phantom['SP'], phantom['spacing'])
+    mapped, spacing = readNrrd(fileName, mmap=True)
+    self.assertTrue(isinstance(mapped, np.memmap))
+    self.assertEqual(spacing, phantom['spacing'])
+    self.assertTrue(np.array_equal(mapped, readNrrd(fileName)[0]))
+    stats = labelStatistics(mapped, phantom['LA'], len(COLON_REGIONS), 4096)
+    self.assertEqual(stats['total'], labelStatistics(phantom['SP'], phantom['LA'], len(COLON_REGIONS))['total'])
+    del mapped
+
+  def test_Batch(self):
+    """ The batch runner analyses a manifest of two studies and, run again
+    after one checkpoint is deleted, recomputes only that study.
+    """
+    directory = self.directory
+    lines = ["study,timepoint,spect,label"]
+    for n, study in enumerate(('A', 'B')):
+      for tp in TIMEPOINTS[:2]:
+        phantom = makePhantom(16, seed=n)
+        writeNrrd(os.path.join(directory, '%s-%s-SP.nrrd' % (study, tp)), phantom['SP'], phantom['spacing'])
+        writeNrrd(os.path.join(directory, '%s-%s-LA.nrrd' % (study, tp)), phantom['LA'], phantom['spacing'])
+        lines.append("%s,%s,%s-%s-SP.nrrd,%s-%s-LA.nrrd" % (study, tp, study, tp, study, tp))
+    manifest = os.path.join(directory, 'manifest.csv')
+    with open(manifest, 'w') as fp:
+      fp.write("\n".join(lines) + "\n")
+    studies = Batch.readManifest(manifest)
+    self.assertEqual([study for study, rows in studies], ['A', 'B'])
+    self.assertEqual(studies[1][1][0]['spect'], os.path.join(directory, 'B-6HRS-SP.nrrd'))
+    outputDir = os.path.join(directory, 'output')
+    messages = []
+    summary = Batch.runBatch(manifest, outputDir, workers=1, log=messages.append)
+    self.assertEqual((summary['done'], summary['skipped'], summary['failed']), (2, 0, {}))
+    with open(os.path.join(outputDir, 'stats.csv')) as fp:
+      stats = fp.read()
+    os.remove(Batch.checkpointPath(outputDir, 'B'))
+    messages = []
+    summary = Batch.runBatch(manifest, outputDir, workers=1, log=messages.append)
+    self.assertEqual((summary['done'], summary['skipped']), (1, 1))
+    self.assertEqual(messages, ["B done"])
+    with open(os.path.join(outputDir, 'stats.csv')) as fp:
+      self.assertEqual(fp.read(), stats)
+
+
+if __name__ == '__main__':
+  unittest.main()